@@ -1,5 +1,5 @@
 import numpy as np
-from hardware import settings
+from hardware import settings, cached
 from functions import *
 
 class procedure(settings, atom):
@@ -30,6 +30,7 @@ class procedure(settings, atom):
 
         return
 
+    @cached
     def mot(self, t=2, detune=10e6, mot_cooling=5, mot_repump_seed=5, current=5):
 
         ao_channels = {
@@ -56,6 +57,7 @@ class procedure(settings, atom):
 
         return
 
+    @cached
     def cmot(self, t=20e-3, detune=30e6, mot_cooling=1, mot_repump_seed=1, current=10):
 
         do_channels = {"slower_coil": 0}
@@ -65,18 +67,21 @@ class procedure(settings, atom):
 
         return
 
+    @cached
     def pgc(self, t=20e-3, detune=120e6, mot_cooling=0.2, mot_repump_seed=0.1):
 
         self.mot(t=t, detune=detune, mot_cooling=mot_cooling, mot_repump_seed=mot_repump_seed, current=-10)
 
         return
 
+    @cached
     def drsc(self, t=10e-3, detune=251e6, drsc=5, optpump=1, current=-10, bias_x=1, bias_y=1, bias_z=0):
 
         # Degenerate Raman sideband cooling procedure
 
         return
 
+    @cached
     def odt(self, t=2, odt_x_ao=10, odt_y_ao=10, odt_sheet_ao=10, current=0):
 
         ao_channels = {
@@ -91,6 +96,10 @@ class procedure(settings, atom):
         }
 
         do_channels = {
+            "mot_cooling_shutter": 0,
+            "mot_repump_seed_shutter": 0,
+            "slower_coil": 0,
+            "coil_bottom_dir": 0,
             "drsc_shutter": 0,
             "optpump_shutter": 0,
             "coil_top_dir": 1,
@@ -104,22 +113,23 @@ class procedure(settings, atom):
 
         return
 
-    def evap(self, t=4, odt_x_ao=10, odt_y_ao=10, odt_sheet_ao=10, tau=2):
+    @cached
+    def evap(self, t=4, odt_x_ao=10, odt_y_ao=10, odt_sheet_ao=10, tau=2, tol=10e-3):
 
-        step = 10000
-        for i in np.linspace(1e-4, t, num=step):
+        d = t-2 # exp(-i/tau) for i = 0..t, played over t-2
 
-            ao_channels = {
-                "odt_x_ao": odt_x_ao * np.exp(-1*i/tau),
-                "odt_y_ao": odt_y_ao * np.exp(-1*i/tau)
-            }
-            do_channels = {
-                "test_do": 1
-            }
-            self.update((t-2)/step, ao_channels, do_channels, {})
+        ao_channels = {
+            "odt_x_ao": ExpWave(odt_x_ao, 0, d, tau*d/t),
+            "odt_y_ao": ExpWave(odt_y_ao, 0, d, tau*d/t)
+        }
+        do_channels = {
+            "test_do": 1
+        }
+        self.ramp(d, ao_channels, do_channels, tol=tol)
 
         return
 
+    @cached
     def tof(self, t=20e-3, detune=0):
 
         ao_channels = {
@@ -130,6 +140,8 @@ class procedure(settings, atom):
 
         do_channels = {
             "himg_shutter": 1,
+            "coil_top_dir": 0,
+            "test_do": 0,
 
             "odt_x_do": 1,
             "odt_y_do": 1,
@@ -156,10 +168,9 @@ class procedure(settings, atom):
         if self.simulation:
             self.raw_img = np.ones((2, 1024, 1280))
         else:
-            self.update(100e-6, {"img": img}, {"img_trig": 1}, {})
-            self.update(100e-6, {"img": 0}, {"img_trig": 0}, {})
-            self.update(20e-3, {"img": img}, {"img_trig": 1}, {})
-            self.update(20.1e-3, {"img": 0}, {"img_trig": 0}, {})
+            with self.timeline(40.3e-3) as tl: # atom and reference image
+                tl.set("img", [0, 100e-6, 200e-6, 20.2e-3], [img, 0, img, 0])
+                tl.set("img_trig", [0, 100e-6, 200e-6, 20.2e-3], [1, 0, 1, 0])
 
             self.raw_img = np.ones((2, 1024, 1280)) # dummy
 
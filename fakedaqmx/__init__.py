@@ -0,0 +1,167 @@
+# Minimal stand-in for the parts of nidaqmx used by hardware.HardwareSession,
+# for benchmarking per-shot overhead and testing without a PCIe-653x card.
+
+import time
+
+from . import constants
+from . import stream_writers
+
+
+class DaqError(Exception):
+    def __init__(self, message, error_code=-200000, task_name=''):
+        super().__init__(message)
+        self.error_code = error_code
+        self.task_name = task_name
+
+
+class _Channels:
+    def __init__(self, task):
+        self._task = task
+
+    def add_do_chan(self, lines, name_to_assign_to_lines='', line_grouping=constants.LineGrouping.CHAN_FOR_ALL_LINES):
+        self._task._check_open()
+        self._task.lines.append(lines)
+        self._task.calls['add_do_chan'] += 1
+
+
+class _Timing:
+    def __init__(self, task):
+        self._task = task
+
+    def cfg_samp_clk_timing(self, rate, source='', active_edge=None, sample_mode=constants.AcquisitionType.FINITE, samps_per_chan=1000):
+        self._task._check_open()
+        self._task.rate = rate
+        self._task.sample_mode = sample_mode
+        self._task.samps_per_chan = samps_per_chan
+        self._task.committed = False
+        self._task.calls['cfg_samp_clk_timing'] += 1
+
+
+class _OutStream:
+    def __init__(self, task):
+        self._task = task
+        self.regen_mode = constants.RegenerationMode.ALLOW_REGENERATION
+        self.output_buf_size = 0
+
+
+class Task:
+    """Fake DAQmx task.
+
+    Records every call in ``calls`` and keeps the last written buffer.
+    ``speed`` is the wall time spent per second of output in
+    ``wait_until_done`` (0 returns immediately).
+
+    With regeneration disabled the task behaves like a streaming output:
+    writes are appended to ``chunks`` and must fit into the free part of
+    ``out_stream.output_buf_size``, and ``wait_until_done`` plays the
+    buffer back, firing the every-N-samples callback after each N samples
+    and raising an underflow DaqError if the buffer runs dry.
+    """
+
+    speed = 0.
+
+    def __init__(self, new_task_name=''):
+        self.name = new_task_name
+        self.lines = []
+        self.rate = None
+        self.sample_mode = None
+        self.samps_per_chan = 0
+        self.committed = False
+        self.running = False
+        self.closed = False
+        self.data = None
+        self.chunks = [] # writes in streaming mode, in order
+        self.written = 0 # samples written since start of streaming
+        self.transferred = 0 # samples played back
+        self.every_n = 0
+        self.callback = None
+        self.calls = {i: 0 for i in ('add_do_chan', 'cfg_samp_clk_timing', 'commit', 'write', 'start', 'stop', 'callback')}
+
+        self.do_channels = _Channels(self)
+        self.timing = _Timing(self)
+        self.out_stream = _OutStream(self)
+
+    def _check_open(self):
+        if self.closed:
+            raise DaqError("Task has been closed.", -200088, self.name)
+
+    def control(self, action):
+        self._check_open()
+        if action == constants.TaskMode.TASK_COMMIT:
+            self.committed = True
+            self.calls['commit'] += 1
+
+    def _streaming(self):
+        return self.out_stream.regen_mode == constants.RegenerationMode.DONT_ALLOW_REGENERATION
+
+    def register_every_n_samples_transferred_from_buffer_event(self, sample_interval, callback_method):
+        self._check_open()
+        if self.running:
+            raise DaqError("Events cannot be registered while the task is running.", -200986, self.name)
+        self.every_n = sample_interval if callback_method is not None else 0
+        self.callback = callback_method
+
+    def write(self, data, auto_start=True, timeout=10.0):
+        self._check_open()
+        self.calls['write'] += 1
+
+        if self._streaming():
+            free = self.out_stream.output_buf_size - (self.written - self.transferred)
+            if len(data) > free:
+                raise DaqError("Write cannot be performed, because the number of samples exceeds the free buffer space.", -200292, self.name)
+            if self.written + len(data) > self.samps_per_chan:
+                raise DaqError("Write exceeds the number of samples per channel of the finite task.", -200288, self.name)
+            self.chunks.append(data)
+            self.written += len(data)
+            self.data = data
+        else:
+            if self.running:
+                raise DaqError("Cannot write while the task is running.", -200547, self.name)
+            if self.samps_per_chan and len(data) != self.samps_per_chan:
+                raise DaqError("Write length does not match the configured samples per channel.", -200292, self.name)
+            self.data = data
+
+        if auto_start:
+            self.start()
+        return len(data)
+
+    def start(self):
+        self._check_open()
+        if self.data is None:
+            raise DaqError("No data has been written to the output buffer.", -200462, self.name)
+        self.committed = True # starting an uncommitted task commits it implicitly
+        self.running = True
+        self.transferred = 0
+        self.calls['start'] += 1
+
+    def wait_until_done(self, timeout=10.0):
+        duration = self.samps_per_chan/self.rate if self.rate else 0.
+        if duration > timeout:
+            raise DaqError("Wait Until Done did not indicate that the task was done within the specified timeout.", -200560, self.name)
+        time.sleep(duration*self.speed)
+
+        if self._streaming(): # play back the buffer
+            while self.transferred < self.samps_per_chan:
+                step = min(self.every_n or self.samps_per_chan, self.samps_per_chan - self.transferred)
+                if self.written - self.transferred < step:
+                    raise DaqError("Output buffer underflow: the application did not write data fast enough.", -200290, self.name)
+                self.transferred += step
+                if self.callback is not None and self.transferred % self.every_n == 0:
+                    self.calls['callback'] += 1
+                    self.callback(0, constants.EveryNSamplesEventType.TRANSFERRED_FROM_BUFFER, self.every_n, None)
+
+    def stop(self):
+        self.running = False
+        self.written = 0
+        self.transferred = 0
+        self.calls['stop'] += 1
+
+    def close(self):
+        self.running = False
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,31 @@
+from enum import Enum
+
+
+class LineGrouping(Enum):
+    CHAN_PER_LINE = 0
+    CHAN_FOR_ALL_LINES = 1
+
+
+class AcquisitionType(Enum):
+    FINITE = 10178
+    CONTINUOUS = 10123
+
+
+class TaskMode(Enum):
+    TASK_START = 0
+    TASK_STOP = 1
+    TASK_VERIFY = 2
+    TASK_COMMIT = 3
+    TASK_RESERVE = 4
+    TASK_UNRESERVE = 5
+    TASK_ABORT = 6
+
+
+class RegenerationMode(Enum):
+    ALLOW_REGENERATION = 10097
+    DONT_ALLOW_REGENERATION = 10158
+
+
+class EveryNSamplesEventType(Enum):
+    ACQUIRED_INTO_BUFFER = 1
+    TRANSFERRED_FROM_BUFFER = 2
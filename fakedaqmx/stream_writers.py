@@ -0,0 +1,15 @@
+import numpy as np
+
+
+class DigitalSingleChannelWriter:
+    """Fake of nidaqmx.stream_writers.DigitalSingleChannelWriter."""
+
+    def __init__(self, task_out_stream, auto_start=False):
+        self._task = task_out_stream._task
+        self.auto_start = auto_start
+
+    def write_many_sample_port_uint32(self, data, timeout=10.0):
+        # the real writer requires a C-contiguous uint32 array
+        if not isinstance(data, np.ndarray) or data.dtype != np.uint32 or not data.flags['C_CONTIGUOUS']:
+            raise TypeError("data must be a C-contiguous numpy.uint32 array")
+        return self._task.write(data, auto_start=self.auto_start, timeout=timeout)
@@ -0,0 +1,8 @@
+# Minimal stand-in for a Novatech 409B on a serial port, for testing
+# novatech409b.driver without the device. Importing it registers the
+# fakenovatech:// URL with pyserial, e.g. Novatech409B('fakenovatech://').
+
+import serial
+
+if __name__ not in serial.protocol_handler_packages:
+    serial.protocol_handler_packages.append(__name__)
@@ -0,0 +1,83 @@
+# pyserial handler for fakenovatech:// ports: a 409B that acknowledges every
+# command with "OK", except the replies given in Serial.replies
+
+import time
+
+from serial.serialutil import SerialBase, PortNotOpenError, to_bytes
+
+
+class Serial(SerialBase):
+
+    def open(self):
+        self.received = bytearray() # every byte written to the device
+        self.table = {} # (channel, index) -> (frequency, phase, amplitude, dwell) words
+        self.mode = None
+        self.commands = 0 # commands received so far
+        self.replies = {} # command number -> reply instead of the device's own, e.g. {3: '?1'}
+        self.mute = False # swallow commands without replying
+        self._line = bytearray()
+        self._out = bytearray()
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def _reconfigure_port(self):
+        pass
+
+    @property
+    def in_waiting(self):
+        if not self.is_open:
+            raise PortNotOpenError()
+        return len(self._out)
+
+    def read(self, size=1):
+        if not self.is_open:
+            raise PortNotOpenError()
+        if not self._out and self._timeout: # nothing to say, as a real port waits out its timeout
+            time.sleep(self._timeout)
+        data = bytes(self._out[:size])
+        del self._out[:size]
+        return data
+
+    def write(self, data):
+        if not self.is_open:
+            raise PortNotOpenError()
+        data = to_bytes(data)
+        self.received += data
+        self._line += data
+        while b"\n" in self._line:
+            i = self._line.index(b"\n")
+            cmd = self._line[:i].rstrip().decode()
+            del self._line[:i+1]
+            reply = self.replies.get(self.commands, self._execute(cmd))
+            self.commands += 1
+            if not self.mute:
+                self._out += reply.encode() + b"\r\n"
+        return len(data)
+
+    def _execute(self, cmd):
+        # the table commands the driver uploads, anything else is acknowledged
+        if cmd.startswith("t"): # tN iiii ffffffff,pppp,aaaa,dd
+            try:
+                channel, index = int(cmd[1]), int(cmd[3:7], 16)
+                fields = tuple(int(i, 16) for i in cmd[8:].split(","))
+            except ValueError:
+                return "?0"
+            if channel > 3 or len(fields) != 4:
+                return "?0"
+            if fields[2] > 1023:
+                return "?7"
+            self.table[channel, index] = fields
+        elif cmd.startswith("m "):
+            self.mode = cmd[2:]
+        return "OK"
+
+    def flush(self):
+        pass
+
+    def reset_input_buffer(self):
+        self._out.clear()
+
+    def reset_output_buffer(self):
+        pass
@@ -1,5 +1,8 @@
+import os
 import numpy as np
 from scipy import optimize
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 from configparser import ConfigParser
 
 # user defined functions
@@ -16,6 +19,76 @@ def SineMod(initial, final, step, frequency, phase=0):
 def StepMod(initial, final, step, frequency):
     return
 
+# waveforms, sampled by settings.ramp only where the output has to change
+
+class waveform:
+
+    # voltage as a function of time (sec) from the start, holding its end value after duration
+
+    def __init__(self, f, duration):
+        self.f = f # vectorized f(t)
+        self.duration = duration
+
+    def __call__(self, t):
+        t = np.asarray(t, dtype=float)
+        return np.broadcast_to(self.f(np.clip(t, 0, self.duration)), t.shape).astype(float)
+
+    def _wave(self, other):
+        return other if isinstance(other, waveform) else waveform(lambda t: other, 0)
+
+    def __add__(self, other):
+        other = self._wave(other)
+        return waveform(lambda t: self(t) + other(t), max(self.duration, other.duration))
+
+    def __mul__(self, other):
+        other = self._wave(other)
+        return waveform(lambda t: self(t) * other(t), max(self.duration, other.duration))
+
+    def __neg__(self):
+        return self * -1
+
+    def __sub__(self, other):
+        return self + -self._wave(other)
+
+    def __rsub__(self, other):
+        return -self + other
+
+    __radd__ = __add__
+    __rmul__ = __mul__
+
+    def then(self, other):
+        # self followed by other
+        other, d = self._wave(other), self.duration
+        return waveform(lambda t: np.where(t < d, self(t), other(t - d)), d + other.duration)
+
+    def sample(self, clock, ticks=None, tol=None, resolution=10e-6):
+        # (tick, value) pairs over [0, ticks) where the held value changes: a new 16-bit DAC code,
+        # or a move of more than tol (V); the curve is looked at every resolution (sec)
+        ticks = int(round(self.duration*clock)) if ticks is None else ticks
+        n = max(int(round(resolution*clock)), 1) # grid spacing (ticks)
+        chunk = n*2**20 # bounded memory for long waveforms
+
+        out_ticks, out_values, last = [], [], None
+        for a in range(0, max(ticks, 1), chunk):
+            k = np.arange(a, min(a+chunk, max(ticks, 1)), n)
+            v = self(k/clock)
+            q = np.floor((v+10.0)*65535/20) if tol is None else np.round(v/tol) # DAC code or error bin
+            keep = np.r_[last is None or q[0] != last, q[1:] != q[:-1]]
+            out_ticks.append(k[keep])
+            out_values.append(v[keep])
+            last = q[-1]
+
+        return np.concatenate(out_ticks), np.concatenate(out_values)
+
+def LineWave(initial, final, duration):
+    return waveform(lambda t: initial + (final-initial)*t/duration, duration)
+
+def ExpWave(initial, final, duration, tau):
+    return waveform(lambda t: final + (initial-final)*np.exp(-1*t/tau), duration)
+
+def SineWave(amplitude, frequency, duration, phase=0, offset=0):
+    return waveform(lambda t: offset + amplitude*np.sin(2*np.pi*frequency*t + phase), duration)
+
 # physical constants
 
 class Cs133:
@@ -55,10 +128,77 @@ class atom(Cs133):
         # absorption imaging
         self.raw_img = np.ones((2, 1024, 1280))
         self.bg_img = config['imaging']['bg_img']
-        self.abs_img = -np.log10((self.raw_img[0])/(self.raw_img[1]))
+        self.abs_img = self.optical_density(self.raw_img[0], self.raw_img[1])
 
         super().__init__()
 
+#### Absorption imaging ####
+
+    def _od_buffers(self, shape):
+        # float32 scratch frames and imaging settings, read and allocated on the first shot
+        buf = getattr(self, '_od', None)
+        if buf is None or buf['atoms'].shape != shape:
+            config = ConfigParser()
+            config.read('config.ini')
+            imaging = config['imaging']
+            buf = self._od = {
+                'atoms': np.empty(shape, np.float32),
+                'probe': np.empty(shape, np.float32),
+                'mask': np.empty(shape, bool),
+                'flag': np.empty(shape, bool),
+                'dark': np.load(imaging['bg_img']).astype(np.float32) if imaging['bg_img'] else None,
+                'alpha': float(imaging.get('alpha') or 1.),
+                'isat': float(imaging.get('isat_counts') or np.inf), # counts per pixel per exposure
+                'max_counts': float(imaging.get('max_counts') or np.inf)
+            }
+        return buf
+
+    def optical_density(self, atoms, probe, dark=None, out=None, mask_out=None):
+        """Returns alpha*ln(probe/atoms) + (probe-atoms)/isat_counts, the
+        optical density of an absorption image in float32, after subtracting
+        the dark frame (bg_img from the config if not given). Pixels saturated
+        in either frame or without probe light are set to 0 and flagged in
+        self.mask. Writes into out and mask_out if given; the scratch frames
+        are reused, so without mask_out self.mask is only valid until the
+        next call"""
+        buf = self._od_buffers(np.shape(atoms))
+        a, p, mask, flag = buf['atoms'], buf['probe'], buf['mask'], buf['flag']
+        dark = buf['dark'] if dark is None else dark
+        out = np.empty(a.shape, np.float32) if out is None else out
+
+        np.greater_equal(atoms, buf['max_counts'], out=mask) # saturated camera
+        np.greater_equal(probe, buf['max_counts'], out=flag)
+        mask |= flag
+
+        np.copyto(a, atoms, casting='unsafe')
+        np.copyto(p, probe, casting='unsafe')
+        if dark is not None:
+            a -= dark
+            p -= dark
+        np.less_equal(p, 0, out=flag) # no probe light
+        mask |= flag
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            np.divide(p, a, out=out)
+            np.log(out, out=out)
+        if buf['alpha'] != 1:
+            out *= buf['alpha']
+        if np.isfinite(buf['isat']): # saturation correction
+            np.subtract(p, a, out=a)
+            a *= 1/buf['isat']
+            out += a
+
+        np.isfinite(out, out=flag) # no light through the cloud
+        np.logical_not(flag, out=flag)
+        mask |= flag
+        np.copyto(out, 0, where=mask)
+        if mask_out is not None:
+            np.copyto(mask_out, mask)
+            mask = mask_out
+        self.mask = mask
+
+        return out
+
     # 2D Gaussian fitting from
     # https://github.com/scipy/scipy-cookbook/blob/master/ipython/FittingData.ipynb
     def gaussian(self, height, center_x, center_y, width_x, width_y):
@@ -67,30 +207,269 @@ class atom(Cs133):
         width_y = float(width_y)
         return lambda x,y: height*np.exp(-(((center_x-x)/width_x)**2+((center_y-y)/width_y)**2)/2)
 
-    def _moments(self, data):
+    @staticmethod
+    def _moments(data):
         """Returns (height, x, y, width_x, width_y)
         the gaussian parameters of a 2D distribution by calculating its
         moments """
         total = data.sum()
-        X, Y = np.indices(data.shape)
-        x = (X*data).sum()/total
-        y = (Y*data).sum()/total
-        col = data[:, int(y)]
-        width_x = np.sqrt(np.abs((np.arange(col.size)-y)**2*col).sum()/col.sum())
-        row = data[int(x), :]
-        width_y = np.sqrt(np.abs((np.arange(row.size)-x)**2*row).sum()/row.sum())
+        x = (np.arange(data.shape[0])*data.sum(axis=1)).sum()/total # marginals instead of index grids
+        y = (np.arange(data.shape[1])*data.sum(axis=0)).sum()/total
+        col = data[:, int(np.clip(y, 0, data.shape[1]-1))]
+        width_x = np.sqrt(np.abs((np.arange(col.size)-x)**2*col).sum()/col.sum())
+        row = data[int(np.clip(x, 0, data.shape[0]-1)), :]
+        width_y = np.sqrt(np.abs((np.arange(row.size)-y)**2*row).sum()/row.sum())
         height = data.max()
         return height, x, y, width_x, width_y
 
-    def fitgaussian(self, data):
-        """Returns (height, x, y, width_x, width_y)
-        the gaussian parameters of a 2D distribution found by a fit"""
-        params = self._moments(data)
-        errorfunction = lambda p: np.ravel(self.gaussian(*p)(*np.indices(data.shape)) - data)
-        p, success = optimize.leastsq(errorfunction, params)
+    @staticmethod
+    def _extent(data):
+        """Returns (height, x, y, width_x, width_y) from the peaks and
+        half widths of the marginals, which average out the noise"""
+        p = [data.max()]
+        for m in (data.sum(axis=1), data.sum(axis=0)):
+            m = m - np.median(m)
+            i = int(np.argmax(m))
+            below = np.flatnonzero(m < m[i]/2)
+            lo, hi = below[below < i], below[below > i]
+            lo, hi = lo[-1]+1 if lo.size else 0, hi[0] if hi.size else m.size
+            p += [i, max((hi-lo)/2.3548, 1.)] # fwhm
+        return p[0], p[1], p[3], p[2], p[4]
+
+    @staticmethod
+    def _roi(shape, p, roi, binning):
+        """Returns ((x0, x1), (y0, y1)) pixel ranges within roi widths
+        of the center, whole bins"""
+        ranges = []
+        for c, w, n in ((p[1], p[3], shape[0]), (p[2], p[4], shape[1])):
+            half = max(roi*abs(w), 4*binning) if roi is not None and np.isfinite(c+w) else n
+            lo, hi = int(max(c-half, 0)), int(min(c+half+1, n))
+            if hi-lo < 4*binning: # degenerate estimate
+                lo, hi = 0, n
+            ranges.append((lo, lo+(hi-lo)//binning*binning))
+        return ranges
+
+    @staticmethod
+    def _profiles(p, x, y):
+        """Returns the separable gaussian factors along x and y and the
+        scaled offsets (x-center_x)/width_x, (y-center_y)/width_y"""
+        height, center_x, center_y, width_x, width_y = p
+        dx, dy = (x-center_x)/width_x, (y-center_y)/width_y
+        return np.exp(-dx**2/2), np.exp(-dy**2/2), dx, dy
+
+    @staticmethod
+    def _residual(p, x, y, data):
+        ex, ey, dx, dy = atom._profiles(p, x, y)
+        return (p[0]*np.outer(ex, ey) - data).ravel()
+
+    @staticmethod
+    def _jacobian(p, x, y, data):
+        """Returns the analytic derivatives of _residual, one row per parameter"""
+        height, center_x, center_y, width_x, width_y = p
+        ex, ey, dx, dy = atom._profiles(p, x, y)
+        g = np.outer(ex, ey)
+        jac = np.empty((5,) + g.shape)
+        jac[0] = g
+        jac[1] = height*g*(dx/width_x)[:, None]
+        jac[2] = height*g*(dy/width_y)[None, :]
+        jac[3] = height*g*(dx**2/width_x)[:, None]
+        jac[4] = height*g*(dy**2/width_y)[None, :]
+        return jac.reshape(5, -1)
+
+    @staticmethod
+    def _diverged(p, success, shape, seed):
+        """Returns True if a seeded fit failed, lost the cloud or blew up"""
+        return (success not in (1, 2, 3, 4) or not np.isfinite(p).all() or p[0]*seed[0] <= 0
+            or not (0 <= p[1] < shape[0] and 0 <= p[2] < shape[1])
+            or not (0.5 <= abs(p[3]) <= shape[0] and 0.5 <= abs(p[4]) <= shape[1]))
+
+    @staticmethod
+    def _fit(data, roi=4, binning=1, seed=None):
+        """Returns (height, x, y, width_x, width_y), success, nfev
+        the gaussian parameters of a 2D distribution found by a fit
+        on the pixels within roi widths of the cloud (None for
+        the whole image), averaged over binning x binning blocks, and
+        the number of residual evaluations. A previous result given as
+        seed replaces the moments estimate, which is the fallback if the
+        seeded fit diverges"""
+        data = np.asarray(data)
+        assert np.any(data), print('blank image, nothing to fit!') # a seed would otherwise come back as the fit
+        p = None if seed is None else np.array(tuple(seed)[:5], dtype=float)
+        region = atom._roi(data.shape, atom._extent(data) if p is None else p, roi, binning)
+        nfev = 0
+
+        for _ in range(2): # once more if the cloud outgrows the region
+            (x0, x1), (y0, y1) = region
+            crop = data[x0:x1, y0:y1].astype(np.float32) # enough for camera counts and OD
+            if binning > 1:
+                crop = crop.reshape(crop.shape[0]//binning, binning, crop.shape[1]//binning, binning).mean(axis=(1, 3))
+            x = x0 + binning*np.arange(crop.shape[0]) + (binning-1)/2 # pixel coordinates of the bins
+            y = y0 + binning*np.arange(crop.shape[1]) + (binning-1)/2
+            if p is None:
+                h, cx, cy, wx, wy = atom._moments(crop)
+                p = np.array([h, x0+binning*cx+(binning-1)/2, y0+binning*cy+(binning-1)/2, binning*wx, binning*wy])
+
+            p, cov, info, msg, success = optimize.leastsq(atom._residual, p, args=(x, y, crop), Dfun=atom._jacobian, col_deriv=True, full_output=True,
+                maxfev=0 if seed is None else 20) # a good seed converges in a few steps
+            nfev += info['nfev']
+
+            (u0, u1), (v0, v1) = atom._roi(data.shape, p, roi, binning)
+            if roi is None or (u0 >= x0 and u1 <= x1 and v0 >= y0 and v1 <= y1):
+                break
+            region = (min(u0, x0), max(u1, x1)), (min(v0, y0), max(v1, y1))
+            region = tuple((lo, lo+(hi-lo)//binning*binning) for lo, hi in region)
+
+        if seed is not None and atom._diverged(p, success, data.shape, seed):
+            p, success, n = atom._fit(data, roi, binning)
+            return p, success, nfev + n
+
+        p[3:] = abs(p[3:])
+        return p, success, nfev
+
+    def fitgaussian(self, data, roi=4, binning=1, seed=None):
+        """Fits a 2D gaussian to data and stores its parameters, see _fit"""
+        p, success, self.nfev = atom._fit(data, roi, binning, seed)
         (self.od, self.pos_x, self.pos_y, self.width_x, self.width_y) = p
         return success
 
+# optimal reference for absorption images
+
+class reference:
+
+    # truncated SVD basis of probe-only frames (raw counts), updated one shot at a time
+    # and cached on disk; each shot's reference is the basis combination closest to it
+    # outside the atoms
+
+    def __init__(self, rank=20, memory=100, path=''):
+        self.rank = rank
+        self.memory = memory # frames; older ones fade out of the basis
+        self.path = path # .npz cache of the basis, '' for none
+        self.basis = None # pixels x rank, orthonormal columns
+        self.values = None # singular values
+        self.count = 0 # frames added
+        self.shape = None
+
+        if path and os.path.exists(path):
+            self.load()
+
+    def add(self, frames, save=True):
+        """Adds probe-only frames (H x W or N x H x W) to the basis
+        without recomputing it from the earlier frames"""
+        frames = np.asarray(frames, dtype=np.float32)
+        frames = frames.reshape((-1,) + frames.shape[-2:])
+        assert self.shape is None or frames.shape[1:] == self.shape, print('reference frame shape mismatch!', frames.shape[1:], self.shape)
+        x = frames.reshape(len(frames), -1).T
+
+        if self.basis is None:
+            u, s, _ = np.linalg.svd(x, full_matrices=False)
+        else:
+            s = self.values*np.exp(-len(frames)/(2*self.memory)) # forget the old frames
+            p = self.basis.T @ x
+            r = x - self.basis @ p
+            q = self.basis.T @ r # orthogonalize twice for float32
+            r -= self.basis @ q
+            p += q
+            r, t = np.linalg.qr(r)
+            k = np.block([[np.diag(s), p], [np.zeros((len(t), len(s))), t]])
+            w, s, _ = np.linalg.svd(k)
+            u = np.hstack([self.basis, r]) @ w[:, :self.rank].astype(np.float32)
+
+        self.basis = np.ascontiguousarray(u[:, :self.rank], dtype=np.float32)
+        self.values = s[:self.rank]
+        self.count += len(frames)
+        self.shape = frames.shape[1:]
+        if save and self.path:
+            self.save()
+
+        return self
+
+    def _coefficients(self, x, mask):
+        # least squares fit of the basis to x outside mask; the basis is orthonormal, so only
+        # the pixels under the mask enter: (I - B_m.T B_m) c = B.T x - B_m.T x_m
+        m = np.flatnonzero(mask)
+        b = self.basis[m].astype(float)
+        g = np.eye(self.basis.shape[1]) - b.T @ b
+        return np.linalg.solve(g, self.basis.T @ x - b.T @ x[m]).astype(np.float32)
+
+    def reconstruct(self, atoms, mask, out=None):
+        """Returns the reference for an atom frame: the combination of the basis
+        closest to it on the pixels outside mask (True over the atoms)"""
+        assert self.basis is not None, print('reference library is empty!')
+        assert np.shape(atoms) == self.shape, print('reference frame shape mismatch!', np.shape(atoms), self.shape)
+        c = self._coefficients(np.ravel(atoms).astype(np.float32, copy=False), mask)
+        out = np.empty(self.shape, np.float32) if out is None else out
+        np.dot(self.basis, c, out=out.reshape(-1))
+        return out
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f: # never leave a half written cache
+            np.savez(f, basis=self.basis, values=self.values, count=self.count, shape=self.shape)
+        os.replace(tmp, self.path)
+
+    def load(self):
+        with np.load(self.path) as cache:
+            self.basis = cache['basis']
+            self.values = cache['values']
+            self.count = int(cache['count'])
+            self.shape = tuple(int(i) for i in cache['shape'])
+
+#### Batch fitting ####
+
+fit_dtype = np.dtype([('od', 'f8'), ('pos_x', 'f8'), ('pos_y', 'f8'), ('width_x', 'f8'), ('width_y', 'f8'), ('success', '?'), ('nfev', 'i4')])
+
+def _fit_frames(images, frames, roi, binning, warm):
+    # fit some frames of the stack in order, rows of fit_dtype
+    rows = np.zeros(len(frames), dtype=fit_dtype)
+    seed = None
+    for k, i in enumerate(frames):
+        try:
+            p, success, nfev = atom._fit(images[i], roi, binning, seed)
+        except (AssertionError, ValueError, ArithmeticError, np.linalg.LinAlgError): # e.g. a blank no-atom frame, keep the rest of the batch
+            p, success, nfev = [np.nan]*5, 0, 0
+        rows[k] = tuple(p) + (success in (1, 2, 3, 4), nfev)
+        if warm:
+            seed = p if rows[k]['success'] else None
+    return rows
+
+def _fit_shared(name, shape, dtype, frames, roi, binning, warm):
+    # runs in the worker: attach to the parent's stack instead of unpickling it
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        return _fit_frames(np.ndarray(shape, dtype=dtype, buffer=shm.buf), frames, roi, binning, warm)
+    finally:
+        shm.close()
+
+def fitgaussians(images, roi=4, binning=1, workers=None, executor=None, warm=False):
+    """Returns a structured array of fit_dtype with the gaussian fit of each
+    image of an N x H x W stack. The frames are fitted in a process pool
+    (or executor, kept open by the caller) reading the stack from shared memory.
+    With warm, each frame is seeded with the fit of the previous one in its chunk"""
+    images = np.ascontiguousarray(images)
+    workers = workers or os.cpu_count()
+    frames = np.array_split(np.arange(len(images)), max(min(len(images), 4*workers), 1)) # a few chunks per worker for balance
+
+    if executor is None and workers == 1:
+        return _fit_frames(images, np.arange(len(images)), roi, binning, warm)
+
+    result = np.zeros(len(images), dtype=fit_dtype)
+    shm = shared_memory.SharedMemory(create=True, size=max(images.nbytes, 1))
+    pool = executor if executor is not None else ProcessPoolExecutor(max_workers=workers)
+
+    try:
+        np.ndarray(images.shape, dtype=images.dtype, buffer=shm.buf)[:] = images
+        pending = [(i, pool.submit(_fit_shared, shm.name, images.shape, images.dtype.str, i, roi, binning, warm)) for i in frames]
+        for i, future in pending:
+            result[i] = future.result()
+
+    finally:
+        if executor is None:
+            pool.shutdown(cancel_futures=True)
+        shm.close()
+        shm.unlink()
+
+    return result
+
 if __name__ == "__main__":
     print(LineRamp(0, 10, 10))
     print(ExpRamp(0, 10, 10, 1))
@@ -1,18 +1,789 @@
 import numpy as np
+import copy
+import functools
+import time
+import timeit
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
-from novatech409b import driver
+from novatech409b.driver import Novatech409B
 try:
     import nidaqmx
-    from nidaqmx.constants import (LineGrouping, AcquisitionType)
+    import nidaqmx.stream_writers
 except ImportError:
-    pass
+    nidaqmx = None
 #import PySpin
 #from andor2 import Andor
 
+class eventlist:
+
+    # compact (tick, word) store, densified into the NI buffer only at run time
+
+    def __init__(self, size=4096):
+        self.ticks = np.zeros(size, dtype=np.int64) # sample index of each word
+        self.words = np.zeros(size, dtype=np.uint32) # data word
+        self.length = 0
+
+        self.starts = np.zeros(64, dtype=np.int64) # pulse windows [start, stop)
+        self.stops = np.zeros(64, dtype=np.int64)
+        self.pulse_words = np.zeros(64, dtype=np.uint32)
+        self.pulse_length = 0
+
+    def _grow(self, array, size):
+        if size <= array.size:
+            return array
+        new = np.zeros(max(size, 2*array.size), dtype=array.dtype) # amortized doubling
+        new[:array.size] = array
+        return new
+
+    def append(self, ticks, words):
+        ticks = np.atleast_1d(np.asarray(ticks, dtype=np.int64))
+        words = np.atleast_1d(np.asarray(words, dtype=np.uint32))
+        n = self.length + ticks.size
+
+        self.ticks = self._grow(self.ticks, n)
+        self.words = self._grow(self.words, n)
+        self.ticks[self.length:n] = ticks
+        self.words[self.length:n] = words
+        self.length = n
+
+        return
+
+    def run(self, start, words):
+        # words at consecutive ticks from start, without the conversions of append
+        n = self.length + len(words)
+        if n > self.ticks.size:
+            self.ticks = self._grow(self.ticks, n)
+            self.words = self._grow(self.words, n)
+        self.ticks[self.length:n] = np.arange(start, start+len(words))
+        self.words[self.length:n] = words
+        self.length = n
+        return
+
+    def pulse(self, starts, stops, word):
+        starts = np.atleast_1d(np.asarray(starts, dtype=np.int64))
+        stops = np.atleast_1d(np.asarray(stops, dtype=np.int64))
+        n = self.pulse_length + starts.size
+
+        self.starts = self._grow(self.starts, n)
+        self.stops = self._grow(self.stops, n)
+        self.pulse_words = self._grow(self.pulse_words, n)
+        self.starts[self.pulse_length:n] = starts
+        self.stops[self.pulse_length:n] = stops
+        self.pulse_words[self.pulse_length:n] = word
+        self.pulse_length = n
+
+        return
+
+    def dense(self, samples):
+        data = np.zeros(samples, dtype=np.uint32, order='C')
+
+        ticks = self.ticks[:self.length]
+        keep = ticks < samples
+        np.bitwise_or.at(data, ticks[keep], self.words[:self.length][keep]) # words sharing a tick are OR-ed
+
+        for i in range(self.pulse_length): # pulse windows, e.g. Novatech trigger
+            data[self.starts[i]:self.stops[i]] |= self.pulse_words[i]
+
+        return data
+
+    def chunks(self, samples, size):
+        # dense buffer generated in consecutive pieces of at most size samples
+        order = np.argsort(self.ticks[:self.length], kind='stable')
+        ticks, words = self.ticks[:self.length][order], self.words[:self.length][order]
+
+        order = np.argsort(self.starts[:self.pulse_length], kind='stable') # windows never overlap, so stops are sorted too
+        starts, stops, pulse_words = self.starts[:self.pulse_length][order], self.stops[:self.pulse_length][order], self.pulse_words[:self.pulse_length][order]
+
+        for a in range(0, samples, size):
+            b = min(a+size, samples)
+            data = np.zeros(b-a, dtype=np.uint32, order='C')
+
+            i0, i1 = np.searchsorted(ticks, [a, b])
+            np.bitwise_or.at(data, ticks[i0:i1]-a, words[i0:i1])
+
+            for i in range(np.searchsorted(stops, a, side='right'), np.searchsorted(starts, b)): # windows overlapping [a, b)
+                data[max(starts[i]-a, 0):min(stops[i], b)-a] |= pulse_words[i]
+
+            yield data
+
+    def slice(self, start, pulse_start, origin=0):
+        # copy of the events appended since (start, pulse_start), relative to tick origin
+        block = eventlist(max(self.length-start, 1))
+        block.append(self.ticks[start:self.length]-origin, self.words[start:self.length])
+        block.pulse(self.starts[pulse_start:self.pulse_length]-origin, self.stops[pulse_start:self.pulse_length]-origin, 0)
+        block.pulse_words[:block.pulse_length] = self.pulse_words[pulse_start:self.pulse_length]
+        return block
+
+    def extend(self, block, offset=0):
+        # splice a relative block in at tick offset
+        self.append(block.ticks[:block.length]+offset, block.words[:block.length])
+        self.pulse(block.starts[:block.pulse_length]+offset, block.stops[:block.pulse_length]+offset, 0)
+        self.pulse_words[self.pulse_length-block.pulse_length:self.pulse_length] = block.pulse_words[:block.pulse_length]
+        return
+
+    def runs(self, start=0, stop=None):
+        # occupied ticks of events [start, stop) merged into contiguous [start, stop) runs
+        ticks = np.sort(self.ticks[start:self.length if stop is None else stop]) # mostly sorted already
+        if ticks.size == 0:
+            return ticks, ticks
+        breaks = np.flatnonzero(np.diff(ticks) > 1) + 1
+        return ticks[np.r_[0, breaks]], ticks[np.r_[breaks-1, ticks.size-1]] + 1
+
+    @property
+    def nbytes(self):
+        return self.ticks.nbytes + self.words.nbytes + self.starts.nbytes + self.stops.nbytes + self.pulse_words.nbytes
+
+class intervalindex:
+
+    # sorted, disjoint [start, stop) tick intervals with the procedure owning each, for O(log n) collision checks
+
+    _grow = eventlist._grow
+
+    def __init__(self, size=1024):
+        self.starts = np.zeros(size, dtype=np.int64)
+        self.stops = np.zeros(size, dtype=np.int64)
+        self.owner = np.zeros(size, dtype=np.int32) # index into owners
+        self.owners = []
+        self._ids = {} # owner -> index
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    @property
+    def end(self):
+        # first tick after the last interval
+        return int(self.stops[self.length-1]) if self.length else -1
+
+    def find(self, start, stop):
+        # index of an interval overlapping [start, stop), -1 if free
+        n = self.length
+        if n == 0 or start >= self.stops[n-1]: # appending, the usual case
+            return -1
+        i = int(np.searchsorted(self.stops[:n], start, side='right')) # first interval ending after start
+        return i if i < n and self.starts[i] < stop else -1
+
+    def find_many(self, starts, stops):
+        # vectorized find
+        n = self.length
+        i = np.searchsorted(self.stops[:n], starts, side='right')
+        hit = (i < n) & (self.starts[np.minimum(i, max(n-1, 0))] < stops) if n else np.zeros(len(i), dtype=bool)
+        return np.where(hit, i, -1)
+
+    def add(self, starts, stops, owner):
+        # insert free intervals, see find
+        k = self._ids.get(owner)
+        if k is None:
+            k = self._ids[owner] = len(self.owners)
+            self.owners.append(owner)
+
+        n = self.length
+        if type(starts) is int and n < self.starts.size and (n == 0 or starts >= self.stops[n-1]): # single update
+            self.starts[n], self.stops[n], self.owner[n] = starts, stops, k
+            self.length += 1
+            return
+
+        starts = np.atleast_1d(np.asarray(starts, dtype=np.int64))
+        stops = np.atleast_1d(np.asarray(stops, dtype=np.int64))
+        if starts.size == 0:
+            return
+        m = n + starts.size
+        if n == 0 or starts[0] >= self.stops[n-1]: # append
+            for name in ('starts', 'stops', 'owner'):
+                setattr(self, name, self._grow(getattr(self, name), m))
+            self.starts[n:m] = starts
+            self.stops[n:m] = stops
+            self.owner[n:m] = k
+        else:
+            i = np.searchsorted(self.starts[:n], starts)
+            self.starts = np.insert(self.starts[:n], i, starts)
+            self.stops = np.insert(self.stops[:n], i, stops)
+            self.owner = np.insert(self.owner[:n], i, k)
+        self.length = m
+        return
+
+    def nearest(self, start, stop, lo=0, hi=None):
+        # start of the free [s, s+stop-start) closest to start with lo <= s <= hi, None if there is none
+        width = stop - start
+        start = max(start, lo) if hi is None else min(max(start, lo), hi)
+        stop = start + width
+        n = self.length
+        i = int(np.searchsorted(self.stops[:n], start, side='right'))
+        if i == n or self.starts[i] >= stop:
+            return start if lo <= start and (hi is None or start <= hi) else None
+
+        before = None # walk left through the gaps
+        j = i
+        while j >= 0:
+            s = self.starts[j] - width
+            if s < lo:
+                break
+            if j == 0 or s >= self.stops[j-1]:
+                before = int(s)
+                break
+            j -= 1
+
+        after = None # walk right through the gaps
+        j = i
+        while j < n:
+            s = self.stops[j]
+            if hi is not None and s > hi:
+                break
+            if j == n-1 or s + width <= self.starts[j+1]:
+                after = int(s)
+                break
+            j += 1
+
+        if before is None or (after is not None and after - start < start - before):
+            return after
+        return before
+
+    def owner_of(self, i):
+        return self.owners[self.owner[i]]
+
+class block:
+
+    # encoded output of one procedure call, relative to its start tick
+
+    def __init__(self, events, dds_data, span, do_state):
+        self.events = events # relative DAQ events
+        self.dds_data = dds_data # Novatech rows
+        self.span = span # runtime advance (ticks)
+        self.do_state = do_state # digital output state at the end
+        self.runs = events.runs() # occupied tick runs, for the collision index
+
+    @property
+    def nbytes(self):
+        return self.events.nbytes + self.dds_data.nbytes
+
+class blockcache:
+
+    # LRU cache of encoded blocks with a memory cap
+
+    def __init__(self, maxbytes=256e6):
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.blocks = OrderedDict()
+
+    def get(self, key):
+        if key in self.blocks:
+            self.blocks.move_to_end(key)
+            self.hits += 1
+            return self.blocks[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, block):
+        if block.nbytes > self.maxbytes:
+            return
+        if key in self.blocks:
+            self.nbytes -= self.blocks.pop(key).nbytes
+        self.blocks[key] = block
+        self.nbytes += block.nbytes
+        while self.nbytes > self.maxbytes: # evict least recently used
+            self.nbytes -= self.blocks.popitem(last=False)[1].nbytes
+        return
+
+    def clear(self):
+        self.blocks.clear()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        return
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits/total if total else 0.
+
+    def __repr__(self):
+        return 'blockcache(%d blocks, %.1f MB, hit rate %.1f%%)'%(len(self.blocks), self.nbytes/1e6, 100*self.hit_rate)
+
+def cached(method):
+    # memoize a procedure method's encoded words and DDS rows in settings.cache
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.template is not None:
+            if self.template.recording and self._depth == 0: # top-level call becomes a template segment
+                return self.template.record(method.__name__, args, kwargs)
+            args, kwargs = _resolve(args, kwargs, self.template.values)
+        else: # params stand for their defaults outside a template
+            args, kwargs = _resolve(args, kwargs, {})
+
+        owner = self._owner
+        self._owner = method.__name__ if owner == 'update' else owner + '.' + method.__name__ # reported on collisions
+        try:
+            # the function object and the class, not the bare name: same-named methods of other procedures
+            # (or a reloaded module) encode different words, and subclasses may override what the method calls
+            key = (type(self), method, args, tuple(sorted(kwargs.items())), self.config_hash, self._state())
+            try:
+                hit = self.cache.get(key)
+            except TypeError: # unhashable arguments, e.g. arrays
+                return method(self, *args, **kwargs)
+
+            if hit is not None and self.splice(hit):
+                return
+
+            start, pulse_start, nova_index = self.events.length, self.events.pulse_length, self.nova_index
+            origin = self.tick
+
+            method(self, *args, **kwargs)
+
+            if hit is None: # a block that did not fit here was re-encoded around its neighbours, keep the clean one
+                self.cache.put(key, block(self.events.slice(start, pulse_start, origin), self.dds_data[nova_index:self.nova_index].copy(), self.tick-origin, self.do_state))
+        finally:
+            self._owner = owner
+        return
+
+    return wrapper
+
+class param:
+
+    # named placeholder for a procedure argument, patched per shot by a template
+
+    def __init__(self, name, value):
+        self.name = name
+        self.value = value # default
+
+    def __repr__(self):
+        return 'param(%r, %r)'%(self.name, self.value)
+
+def _resolve(args, kwargs, values):
+    # substitute current values for params
+    value = lambda i: values.get(i.name, i.value) if isinstance(i, param) else i
+    return tuple(value(i) for i in args), {i: value(j) for i, j in kwargs.items()}
+
+class segment:
+
+    # one top-level procedure call (or the plain updates between two) inside a template
+
+    def __init__(self, name, args, kwargs, resolved, start, end, state):
+        self.name = name # None for plain update() calls, which are only shifted
+        self.args = args
+        self.kwargs = kwargs
+        self.resolved = resolved
+        (self.i0, self.p0, self.n0, self.offset, _), (self.i1, self.p1, self.n1, tick, self.do_state) = start, end
+        self.span = tick - self.offset # ticks
+        self.state = state # DDS row and digital state inherited from before the segment
+
+class template:
+
+    # procedure compiled once; each shot patches only the segments whose params changed
+
+    def __init__(self, exp):
+        self.exp = exp
+        self.values = {}
+        self.segments = []
+        self.recording = True
+        self.mark = self._mark() # start of the plain updates since the last segment
+        exp.template = self
+
+    def _mark(self):
+        return (self.exp.events.length, self.exp.events.pulse_length, self.exp.nova_index, self.exp.tick, self.exp.do_state)
+
+    def _close(self, name, args, kwargs, start):
+        end = self._mark()
+        if name is None and end == start: # no plain updates in between
+            return
+        state = (tuple(self.exp.dds_data[start[2]-1]), start[4])
+        self.segments.append(segment(name, args, kwargs, _resolve(args, kwargs, self.values), start, end, state))
+        return
+
+    def record(self, name, args, kwargs):
+        self._close(None, (), {}, self.mark)
+
+        start = self._mark()
+        self.exp._depth += 1
+        try:
+            getattr(self.exp, name)(*args, **kwargs)
+        finally:
+            self.exp._depth -= 1
+
+        self._close(name, args, kwargs, start)
+        self.mark = self._mark()
+        return
+
+    def shot(self, **values):
+        # patch the compiled sequence in place for new param values
+        exp = self.exp
+        events = exp.events
+
+        if self.recording:
+            self._close(None, (), {}, self.mark)
+            self.recording = False
+
+        self.values.update(values)
+        if len(self.segments) == 0:
+            return exp
+
+        c = self.segments[0].offset # new start tick
+        do_state = self.segments[0].state[1]
+        shift = 0 # tick shift of the previous segment, None if re-encoded
+        changed = False
+        for index, seg in enumerate(self.segments):
+            state = (tuple(exp.dds_data[seg.n0-1]), do_state)
+            resolved = _resolve(seg.args, seg.kwargs, self.values)
+
+            if seg.name is not None and (resolved != seg.resolved or state != seg.state):
+                self._patch(index, resolved, state, c)
+                moved, shift = True, None
+
+            else: # shift segment to its new start
+                moved, shift = shift != c - seg.offset, c - seg.offset
+                events.ticks[seg.i0:seg.i1] += shift
+                events.starts[seg.p0:seg.p1] += shift
+                events.stops[seg.p0:seg.p1] += shift
+
+            changed |= moved # relative position to the previous segment changed
+
+            # plain updates are emitted relative to the recorded digital state, and their Novatech rows forward-fill the recorded row
+            assert seg.name is not None or (state[1] == seg.state[1] and (seg.n0 == seg.n1 or state[0] == seg.state[0])), print('template state mismatch!', 'plain updates after a patched procedure inherit a different state, wrap them in a @cached procedure')
+
+            seg.offset = c
+            c += seg.span
+            do_state = seg.do_state
+
+        exp.tick = c
+        exp.do_state = do_state
+        if changed:
+            self._reindex()
+
+        return exp
+
+    def _patch(self, index, resolved, state, tick, context=False):
+        # re-encode one segment and write it over the old one, alone or scheduled around the segments before it
+        exp = self.exp
+        events = exp.events
+        seg = self.segments[index]
+
+        scratch = exp._scratch(tick, *state)
+        k = 0 # events before the segment
+        if context: # claims its slots in the index being rebuilt by _reindex
+            scratch.slots, scratch.windows = exp.slots, exp.windows
+            scratch.events.append(events.ticks[:seg.i0], events.words[:seg.i0]) # for the channel latches
+            k = seg.i0
+        getattr(scratch, seg.name)(*resolved[0], **resolved[1])
+        new = scratch.events
+        rows = scratch.dds_data[1:scratch.nova_index]
+
+        if (new.length-k, new.pulse_length, len(rows)) != (seg.i1-seg.i0, seg.p1-seg.p0, seg.n1-seg.n0): # block size changed
+            self._resize(index, new.length-k, new.pulse_length, len(rows))
+
+        events.ticks[seg.i0:seg.i1] = new.ticks[k:new.length]
+        events.words[seg.i0:seg.i1] = new.words[k:new.length]
+        events.starts[seg.p0:seg.p1] = new.starts[:new.pulse_length]
+        events.stops[seg.p0:seg.p1] = new.stops[:new.pulse_length]
+        events.pulse_words[seg.p0:seg.p1] = new.pulse_words[:new.pulse_length]
+        exp.dds_data[seg.n0:seg.n1] = rows
+
+        seg.resolved = None if context else resolved # packed around its neighbours only for this shot
+        seg.state = state
+        seg.span = scratch.tick - tick
+        seg.do_state = scratch.do_state
+        return
+
+    def _reindex(self):
+        # rebuild the collision index from the moved segments in order; a procedure colliding with
+        # the segments before it is re-encoded around them, as in a fresh build
+        exp = self.exp
+        events = exp.events
+        exp.slots, exp.windows = intervalindex(), intervalindex()
+
+        for index, seg in enumerate(self.segments):
+            owner = seg.name or 'update'
+            starts, stops = events.runs(seg.i0, seg.i1)
+            pulse_starts, pulse_stops = events.starts[seg.p0:seg.p1], events.stops[seg.p0:seg.p1]
+            if seg.name is not None and not exp._fits(starts, stops, pulse_starts, pulse_stops, events.ticks[seg.i0:seg.i1], events.words[seg.i0:seg.i1], n=seg.i0):
+                self._patch(index, seg.resolved, seg.state, seg.offset, context=True)
+                continue
+            exp._occupy(exp.slots, starts, stops, owner, (seg.i0, seg.i1))
+            exp._occupy(exp.windows, pulse_starts, pulse_stops, owner)
+
+        return
+
+    def _resize(self, index, length, pulse_length, rows):
+        # make room for a re-encoded segment of a different size
+        exp = self.exp
+        events = exp.events
+        seg = self.segments[index]
+        di, dp, dn = length-(seg.i1-seg.i0), pulse_length-(seg.p1-seg.p0), rows-(seg.n1-seg.n0)
+
+        for name, i0, i1, n, d in (('ticks', seg.i0, seg.i1, events.length, di), ('words', seg.i0, seg.i1, events.length, di),
+                ('starts', seg.p0, seg.p1, events.pulse_length, dp), ('stops', seg.p0, seg.p1, events.pulse_length, dp), ('pulse_words', seg.p0, seg.p1, events.pulse_length, dp)):
+            array = events._grow(getattr(events, name), n+d)
+            array[i1+d:n+d] = array[i1:n].copy() # move tail
+            setattr(events, name, array)
+        events.length += di
+        events.pulse_length += dp
+
+        assert exp.nova_index + dn <= len(exp.dds_data), print('Novatech table full!')
+        exp.dds_data[seg.n1+dn:exp.nova_index+dn] = exp.dds_data[seg.n1:exp.nova_index].copy()
+        exp.nova_index += dn
+
+        seg.i1, seg.p1, seg.n1 = seg.i1+di, seg.p1+dp, seg.n1+dn
+        for i in self.segments[index+1:]:
+            i.i0, i.i1, i.p0, i.p1, i.n0, i.n1 = i.i0+di, i.i1+di, i.p0+dp, i.p1+dp, i.n0+dn, i.n1+dn
+        return
+
+class timeline:
+
+    # events on per-channel tracks at times relative to the start (or absolute), merged into DAQ words and DDS rows in one pass
+
+    def __init__(self, exp, t):
+        self.exp = exp
+        self.origin = exp.tick # start tick
+        self.span = exp.ticks(t) # runtime advance on commit
+        self.tracks = {} # channel name -> [(ticks, values), ...]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, *args):
+        if kind is None:
+            self.commit()
+
+    def set(self, channel, times, values, absolute=False):
+        # values of one channel at times (sec, scalars or arrays) from the start, or from the sequence start if absolute
+        exp = self.exp
+        assert channel in exp.ao_ch or channel in exp.do_bit or channel in exp.dds_col, print('unknown channel!', channel)
+        ticks = exp.ticks(np.atleast_1d(np.asarray(times, dtype=float))) + (0 if absolute else self.origin)
+        values = np.broadcast_to(np.asarray(values, dtype=float), ticks.shape)
+        assert ticks.size == 0 or ticks.min() >= self.origin, print('timeline event before its start!')
+        if ticks.size: # an empty track sets nothing
+            self.tracks.setdefault(channel, []).append((ticks, values))
+        return self
+
+    def _track(self, channel):
+        # ticks and values of one channel sorted by time, the last value set at a tick wins
+        ticks = np.concatenate([i for i, _ in self.tracks[channel]])
+        values = np.concatenate([j for _, j in self.tracks[channel]])
+        order = np.argsort(ticks, kind='stable')
+        ticks, values = ticks[order], values[order]
+        keep = np.r_[ticks[1:] != ticks[:-1], True]
+        return ticks[keep], values[keep]
+
+    def commit(self):
+        # merge all tracks: AO pairs, changed digital boards and a trigger per tick, one Novatech row per DDS tick
+        exp = self.exp
+        ao = [(exp.ao_ch[i],) + self._track(i) for i in self.tracks if i in exp.ao_ch]
+        do = [exp.do_bit[i] + self._track(i) for i in self.tracks if i in exp.do_bit]
+        dds = [(exp.dds_col[i],) + self._track(i) for i in self.tracks if i in exp.dds_col]
+
+        pair_ticks, pair_keys, pair_words = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)], [np.zeros((0, 2), dtype=np.uint32)]
+        for ch, ticks, values in ao: # analog pairs, lowest channel closest to the trigger
+            pair_ticks.append(ticks)
+            pair_keys.append(np.full(ticks.size, -ch))
+            pair_words.append(exp.ao_update(ch, values))
+
+        if do: # digital boards after each digital tick, starting from the current state
+            ticks = np.unique(np.concatenate([i[2] for i in do]))
+            state = exp.do_state if exp.do_state is not None else (0, 0, 0)
+            boards = np.array(state, dtype=np.int64)[:, None].repeat(ticks.size, axis=1)
+            for b, m, t, v in do:
+                k = np.searchsorted(t, ticks, side='right') - 1 # last value set at or before each tick
+                on = np.where(k >= 0, v[np.maximum(k, 0)] != 0, state[b] & m != 0)
+                boards[b] = np.where(on, boards[b] | m, boards[b] & ~m)
+            previous = np.concatenate((np.array(state, dtype=np.int64)[:, None], boards[:, :-1]), axis=1)
+            changed = boards != previous
+            if exp.do_state is None: # first digital write sets every board
+                changed[:, 0] = True
+            for b in range(3): # digital pairs after the analog ones
+                data = boards[b][changed[b]] + int(exp.do_brd_list[b])
+                pair_ticks.append(ticks[changed[b]])
+                pair_keys.append(np.full(data.size, b+1))
+                pair_words.append(np.stack((data + int(exp.strob_int), data), axis=1).astype(np.uint32))
+            exp.do_state = tuple(int(i) for i in boards[:, -1])
+
+        pair_ticks, pair_keys, pair_words = np.concatenate(pair_ticks), np.concatenate(pair_keys), np.concatenate(pair_words)
+        if pair_ticks.size:
+            order = np.lexsort((pair_keys, pair_ticks))
+            pair_ticks, pair_words = pair_ticks[order], pair_words[order]
+            c, first, count = np.unique(pair_ticks, return_index=True, return_counts=True) # one trigger per tick
+            starts, stops = c - 2*count, c + 1
+            rank = np.arange(pair_ticks.size) - np.repeat(first, count)
+            at = np.repeat(starts, count) + 2*rank # strob word tick
+
+            if starts[0] >= exp.slots.end and np.all(starts[1:] >= stops[:-1]): # every tick's words fit before its trigger
+                exp.slots.add(starts, stops, exp._owner)
+                exp.events.append(np.concatenate((at, at+1, c)), np.concatenate((pair_words[:, 0], pair_words[:, 1], np.full(c.size, exp.trig_int, dtype=np.uint32))))
+            else:
+                words = np.split(pair_words, first[1:])
+                exp._schedule(c, [i.ravel().tolist() + [int(exp.trig_int)] for i in words])
+
+        if dds: # Novatech rows, forward filled from the last row
+            ticks = np.unique(np.concatenate([i[1] for i in dds]))
+            rows = np.repeat(exp.dds_data[exp.nova_index-1][None, :], ticks.size, axis=0)
+            for col, t, v in dds:
+                k = np.searchsorted(t, ticks, side='right') - 1
+                rows[k >= 0, col] = v[k[k >= 0]]
+            exp._dds(ticks, rows)
+
+        exp.tick = self.origin + self.span # update runtime
+        return
+
+class simulator:
+
+    # stand-in for the NI card and Novatech: checks and "plays" compiled buffers in scaled real time
+
+    def __init__(self, speed=1.):
+        self.speed = speed # wall time per sequence second, 0 to skip waiting
+        self.shots = [] # (samples, Novatech rows, start, stop) per executed shot
+
+    def execute(self, exp, daq_data, dds_data):
+        start = timeit.default_timer()
+
+        assert daq_data.dtype == np.uint32 and len(daq_data) >= exp.tick, print('DAQ buffer too short!')
+        assert len(dds_data) <= 32768, print('Novatech table full!')
+        time.sleep(len(daq_data)/exp.clock*self.speed)
+
+        self.shots.append((len(daq_data), len(dds_data), start, timeit.default_timer()))
+        return
+
+class HardwareSession:
+
+    # NI-DAQmx task and Novatech connection kept open across shots
+
+    def __init__(self, clock, nova_serial='', device='Dev1', daqmx=None):
+        self.clock = clock # Hz
+        self.nova_serial = nova_serial # port or pyserial URL, e.g. 'fakenovatech://' once fakenovatech is imported
+        self.device = device
+        self.daqmx = nidaqmx if daqmx is None else daqmx # e.g. fakedaqmx for benchmarks without hardware
+
+        self.task = None
+        self.writer = None
+        self.dds = None # Novatech409B, uploads overlap with DAQ preparation
+        self.serial = None # one worker thread keeps the serial commands in order
+        self.samples = 0 # sample count of the committed timing
+
+    def open(self):
+        constants = self.daqmx.constants
+
+        if self.nova_serial != '':
+            self.dds = Novatech409B(self.nova_serial)
+            self.serial = ThreadPoolExecutor(max_workers=1)
+            self.dds.setup()
+
+        self.task = self.daqmx.Task() # create NI-DAQmx task
+        self.task.do_channels.add_do_chan(','.join('%s/port%d/line0:7'%(self.device, i) for i in range(4)), line_grouping=constants.LineGrouping.CHAN_FOR_ALL_LINES) # group all lines
+        self.writer = self.daqmx.stream_writers.DigitalSingleChannelWriter(self.task.out_stream, auto_start=False)
+        self.samples = 0
+
+        return self
+
+    def close(self):
+        if self.task is not None:
+            self.task.close()
+            self.task = None
+        if self.dds is not None:
+            self.serial.shutdown() # after a pending upload
+            self.dds.close()
+            self.dds = None
+            self.serial = None
+        return
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *args):
+        self.close()
+        return
+
+    def execute(self, exp, daq_data, dds_data):
+        if self.task is None:
+            self.open()
+
+        def prepare():
+            if len(daq_data) != self.samples: # re-commit timing only when the sample count changes
+                self._commit(len(daq_data), len(daq_data), self.daqmx.constants.RegenerationMode.ALLOW_REGENERATION)
+            self.writer.write_many_sample_port_uint32(np.ascontiguousarray(daq_data, dtype=np.uint32), timeout=10.) # write data
+
+        try:
+            self._overlap(prepare, dds_data, exp.nova_amp) # DDS upload || DAQ write
+            self.task.start()
+            self.task.wait_until_done(timeout=(len(daq_data)/self.clock+0.1))
+            self.task.stop()
+        except self.daqmx.DaqError as e:
+            print(e)
+
+        return
+
+    def stream(self, exp, dds_data, chunk=2**20, depth=4):
+        # feed the sequence in chunks from the every-N-samples callback; host memory stays at depth*chunk samples
+        if self.task is None:
+            self.open()
+
+        samples = max(int(np.ceil(exp.runtime)*self.clock), exp.slots.end)
+        chunks = exp.events.chunks(samples, chunk)
+        self._commit(samples, min(depth*chunk, samples), self.daqmx.constants.RegenerationMode.DONT_ALLOW_REGENERATION)
+        self.samples = 0 # buffer settings differ from execute()
+
+        def callback(task_handle, event_type, number_of_samples, callback_data):
+            data = next(chunks, None)
+            if data is not None: # refill the space just transferred
+                self.writer.write_many_sample_port_uint32(data, timeout=10.)
+            return 0
+
+        def prefill():
+            for _ in range(depth):
+                data = next(chunks, None)
+                if data is None:
+                    break
+                self.writer.write_many_sample_port_uint32(data, timeout=10.)
+
+        try:
+            self._overlap(prefill, dds_data, exp.nova_amp) # DDS upload || buffer prefill
+            self.task.register_every_n_samples_transferred_from_buffer_event(chunk, callback)
+            self.task.start()
+            self.task.wait_until_done(timeout=(samples/self.clock+1.))
+            self.task.stop()
+        except self.daqmx.DaqError as e:
+            print(e)
+            self.task.stop()
+        finally:
+            self.task.register_every_n_samples_transferred_from_buffer_event(chunk, None)
+
+        return
+
+    def _commit(self, samples, buffer, regen_mode):
+        self.task.timing.cfg_samp_clk_timing(self.clock, sample_mode=self.daqmx.constants.AcquisitionType.FINITE, samps_per_chan=samples) # set NI-DAQmx clock and samples
+        self.task.out_stream.regen_mode = regen_mode
+        self.task.out_stream.output_buf_size = buffer
+        self.task.control(self.daqmx.constants.TaskMode.TASK_COMMIT)
+        self.samples = samples
+        return
+
+    def _overlap(self, prepare, dds_data, full_scale):
+        # run the blocking DAQ preparation while the DDS table uploads in the serial thread; done when both are
+        if self.dds is None:
+            prepare()
+            return
+        upload = self.serial.submit(self._upload, dds_data, full_scale)
+        try:
+            prepare()
+        finally:
+            upload.result()
+        return
+
+    def _upload(self, dds_data, full_scale):
+        try:
+            amps = np.rint(dds_data[:, 2:4]/full_scale*1023) # V -> amplitude DAC value
+            self.dds.upload_table(dds_data[:, 0:2], amps=amps) # cooling and repump frequencies and amplitudes, one serial write
+        except Exception as e:
+            print('Novatech error!', e)
+        return
+
 class settings:
 
+    cache = blockcache() # shared by all shots
+
     def __init__(self, simulation=False):
 
+        self.simulation = simulation
+
         # read configuration
         config = ConfigParser()
         config.read('config.ini')
@@ -41,6 +812,10 @@ class settings:
 
        # dds channels
         self.dds_ch = {int(i): j for i, j in config._sections['dds_ch'].items()}
+        self.dds_col = {j: i for i, j in self.dds_ch.items()} # channel name -> Novatech table column
+
+        # configuration fingerprint for the block cache
+        self.config_hash = hash(tuple((i, tuple(config.items(i))) for i in config.sections()))
 
         # PLL
 
@@ -51,121 +826,455 @@ class settings:
 
         # constant Numpy arrays
 
-        self.daq_data = np.zeros(int(self.clock*100), dtype=np.uint32, order='C') # preallocate data array
-        self.runtime = 100e-6 # dummy time for configurting mot and Novatech trigger
-        self.dds_data = np.zeros((32768, 4), dtype=np.float) # preallocate Novatech array
+        self.events = eventlist() # sparse DAQ data, densified in run()
+        self.tick = self.ticks(100e-6) # current step, dummy time for configurting mot and Novatech trigger
+        self.dds_data = np.zeros((32768, 4), dtype=float) # preallocate Novatech array
+        self.nova_amp = 0.51 # V, Novatech full scale amplitude (DAC value 1023)
+        self.dds_data[:, 2:4] = self.nova_amp # full amplitude unless set
         self.nova_index = 0 # Novatech index number
-        self.nova_set = np.uint32(np.ceil(100e-6*self.clock)) # Novatech minimum trigger width
+        self.nova_set = int(np.ceil(100e-6*self.clock)) # Novatech minimum trigger width
+
+        self.do_state = None # digital board states, None until the first digital update
+        self.slots = intervalindex() # occupied word ticks
+        self.windows = intervalindex() # Novatech trigger windows
+        self._owner = 'update' # procedure being encoded, for collision reports
+        self.template = None # template being recorded or patched
+        self._depth = 0 # nesting level of template segments
 
         self.strob_int = np.uint32(2147483648) # write data int
         self.trig_int = np.uint32(1073741824) # output data int
         self.nova_trig = np.uint32(268435456) # Novatech trigger int
         self.ao_brd_list = np.array([9437184, 1048576, 14680064, 6291456], dtype=np.uint32) # PCB board jumper setting
+        self.do_brd_list = np.array([196608, 131072, 65536], dtype=np.uint32) # left, middle, right board
+
+        # per-channel word tables
+        self.ao_base = self.ao_brd_list[np.arange(32)//8] + np.uint32(65536)*(np.arange(32, dtype=np.uint32)%8) # board + channel address
+        self.do_board = np.arange(48)//16 # board of each digital channel
+        self.do_mask = np.uint32(1) << (np.arange(48, dtype=np.uint32)%16) # bit of each digital channel
+        self.ao_word = {i: int(self.ao_base[j]) for i, j in self.ao_ch.items()} # channel name -> base word
+        self.do_bit = {i: (int(self.do_board[j]), int(self.do_mask[j])) for i, j in self.do_ch.items() if j < 48} # channel name -> (board, bit)
+        self._do_words = {} # (named channels, board states) -> do_merge result
+        self.address = {int(self.ao_base[j]) >> 16 & 255: i for i, j in self.ao_ch.items()} # word address -> channel name
+        self.address.update({0: 'trigger', 3: 'do_left', 2: 'do_middle', 1: 'do_right'})
+
+        # scheduler: how far (ticks) each word address may be output from its target time
+        max_skew = {i: int(float(j)*self.clock) for i, j in config.items('max_skew')}
+        self.skew = np.full(256, max_skew['default'], dtype=np.int64)
+        for i in self.ao_ch:
+            self.skew[self.ao_word[i] >> 16 & 255] = max_skew.get(i, max_skew['default'])
+        for b in range(3): # a digital board is as strict as its strictest channel
+            self.skew[int(self.do_brd_list[b]) >> 16] = min([max_skew.get(i, max_skew['default']) for i, j in self.do_ch.items() if j//16 == b] or [max_skew['default']])
 
 #### Calculation ####
 
+    @property
+    def runtime(self):
+        # sec
+        return self.tick/self.clock
+
+    def ticks(self, t):
+        # sec -> whole clock ticks; durations are rounded once here and kept as integers
+        if isinstance(t, (int, float)): # scalars, the common case in update()
+            return int(round(t*self.clock))
+        return np.rint(np.asarray(t)*self.clock).astype(np.int64) if np.ndim(t) else int(round(t*self.clock))
+
     def update(self, t, ao_channels, do_channels, dds_channels):
-        c = int((self.runtime)*self.clock) # current step
-        d = 0 if len(do_channels) is 0 else 6 # if any digital channel changes
-        k = 0 # iterator
+        c = self.tick # current step
+        n = self.ticks(t)
+        do_words = self.do_merge(do_channels) # only boards whose state changes
+        d = len(do_words)
 
-        assert int(t*self.clock) > 0, print('too short!') # check any update is >= 1 step
-        assert not np.any(self.daq_data[(c-len(ao_channels)*2-d):c]), print('update collision!') # data update collision
+        assert n > 0, print('too short!') # check any update is >= 1 step
 
-        if d is not 0: # update digital data
-            self.daq_data[c-6:c] = self.do_update({self.do_ch[i]: j for i, j in do_channels.items()})
+        words = [] # words for steps c-len(words)+1 .. c, built from the per-channel tables
 
-        for i,j in ao_channels.items(): # update analog data
-            self.daq_data[c-d-k-2:c-d-k] = self.ao_update(self.ao_ch[i], j)
-            k += 2
+        for i, j in reversed(ao_channels.items()): # update analog data, first channel closest to the trigger
+            data_int = int((j+10.0)*65535/20) + self.ao_word[i]
+            words += (data_int + self.strob_int, data_int)
 
-        self.daq_data[c] = self.trig_int # update trigger
-        self.runtime += t # update runtime
+        words += do_words # update digital data
+        words.append(self.trig_int) # update trigger
 
-        if len(dds_channels) is not 0: # if any analog channel changes
+        a = c-len(words)+1
+        if a >= self.slots.end: # words right before the trigger, after everything written so far
+            self.slots.add(a, c+1, self._owner)
+            self.events.run(a, words)
+        else:
+            self._schedule([c], [words])
+        self.tick += n # update runtime
+
+        if len(dds_channels) != 0: # if any analog channel changes
+
+            hit = len(self.windows)-1 if c-self.nova_set < self.windows.end else -1 # rows are played in trigger order
+            assert hit < 0, print('nova trig collision!', self._conflict(self.windows, hit, c-self.nova_set, c, self._owner)) # Novatech trigger collision
+            assert self.nova_index < len(self.dds_data), print('Novatech table full!')
+
+            row = self.dds_data[self.nova_index-1].copy() # Novatech table, unchanged channels carried over
+            for i, j in dds_channels.items():
+                if i in self.dds_col:
+                    row[self.dds_col[i]] = j
+            self._amplitudes(row[None, :])
+            self.windows.add(c-self.nova_set, c, self._owner)
+
+            self.dds_data[self.nova_index] = row
+            self.nova_index += 1
+
+            self.events.pulse(c-self.nova_set, c, self.nova_trig) # update Novatech trigger
+
+        return
+
+    def ramp(self, t, ao_channels, do_channels, tol=None, resolution=10e-6):
+        # vectorized update() per ramp point, the points spread evenly over t rounded to whole ticks
+        if any(hasattr(j, 'sample') for j in ao_channels.values()): # waveforms, see functions.waveform.sample
+            return self._wave(t, ao_channels, do_channels, tol, resolution)
+
+        step = len(next(iter(ao_channels.values())))
+        w = len(ao_channels)*2 # words written per step
+        n = self.ticks(t)
+
+        assert all(len(j) == step for j in ao_channels.values()), print('ramp length mismatch!')
+        assert n >= step, print('too short!') # check any update is >= 1 step
+
+        c = self.tick + (2*np.arange(step, dtype=np.int64)*n + step)//(2*step) # current step of each ramp point, rounded
+
+        do_words = self.do_merge(do_channels) # digital state is constant, so only the first step can change it
+        d = len(do_words)
+
+        starts, stops = c-w, c+1 # occupied ticks of each step
+        starts[0] -= d
+
+        ticks = np.empty((step, w+1), dtype=np.int64)
+        words = np.empty((step, w+1), dtype=np.uint32)
 
-            assert not np.any(np.bitwise_and(268435456, self.daq_data[c-self.nova_set-1:c])), print('nova trig collision!') # Novatech trigger collision
+        for k, (i, j) in enumerate(ao_channels.items()): # update analog data
+            ticks[:, w-2*k-2:w-2*k] = c[:, None] + np.arange(-2*k-2, -2*k)
+            words[:, w-2*k-2:w-2*k] = self.ao_update(self.ao_ch[i], np.asarray(j, dtype=float))
+
+        ticks[:, w] = c # update trigger
+        words[:, w] = self.trig_int
+
+        if starts[0] >= self.slots.end and np.all(starts[1:] >= stops[:-1]): # every step fits before its trigger
+            self.slots.add(starts, stops, self._owner)
+            if d != 0: # update digital data before the first step
+                self.events.append(np.arange(c[0]-w-d, c[0]-w), np.array(do_words, dtype=np.uint32))
+            self.events.append(ticks.ravel(), words.ravel())
+        else: # steps closer than their words, or inserted between earlier writes
+            self._schedule(c, [do_words + words[0].tolist()] + words[1:].tolist())
+        self.tick += n # update runtime
+
+        return
+
+    def timeline(self, t):
+        # parallel channel tracks for the next t seconds, see timeline
+        return timeline(self, t)
+
+    @cached
+    def repeat(self, n, body, *args, **kwargs):
+        # body(self, *args, **kwargs) n times: periods are encoded until one comes out the same as the one before, from the same state,
+        # the remaining ones are bulk copies of it
+        last = None
+        while n > 0:
+            start, pulse_start, nova_index, origin, state = self.events.length, self.events.pulse_length, self.nova_index, self.tick, self._state()
+            body(self, *args, **kwargs)
+            n -= 1
+            period = block(self.events.slice(start, pulse_start, origin), self.dds_data[nova_index:self.nova_index].copy(), self.tick-origin, self.do_state)
+            if last is not None and self._state() == state and self._same(period, last):
+                self._tile(period, n)
+                return
+            last = period
+
+        return
+
+    def _same(self, a, b):
+        # blocks with identical relative contents
+        x, y = a.events, b.events
+        return (a.span == b.span and x.length == y.length and x.pulse_length == y.pulse_length and np.array_equal(a.dds_data, b.dds_data)
+            and np.array_equal(x.ticks[:x.length], y.ticks[:y.length]) and np.array_equal(x.words[:x.length], y.words[:y.length])
+            and np.array_equal(x.starts[:x.pulse_length], y.starts[:y.pulse_length]) and np.array_equal(x.stops[:x.pulse_length], y.stops[:y.pulse_length])
+            and np.array_equal(x.pulse_words[:x.pulse_length], y.pulse_words[:y.pulse_length]))
+
+    def _tile(self, block, n):
+        # place block n times back to back from the current step with bulk copies
+        if n == 0:
+            return
+        c = self.tick + block.span*np.arange(n, dtype=np.int64)[:, None] # start of each copy
+        events, rows = block.events, len(block.dds_data)
+
+        assert block.runs[0].size == 0 or block.runs[1][-1] - block.runs[0][0] <= block.span, print('update collision!', self._owner, 'period of %d ticks writes over %d ticks'%(block.span, block.runs[1][-1] - block.runs[0][0])) # data update collision
+        assert self.nova_index + n*rows <= len(self.dds_data), print('Novatech table full!')
+
+        self._occupy(self.slots, (block.runs[0] + c).ravel(), (block.runs[1] + c).ravel(), self._owner)
+        self._occupy(self.windows, (events.starts[:events.pulse_length] + c).ravel(), (events.stops[:events.pulse_length] + c).ravel(), self._owner)
+
+        self.events.append((events.ticks[:events.length] + c).ravel(), np.tile(events.words[:events.length], n))
+        self.events.pulse((events.starts[:events.pulse_length] + c).ravel(), (events.stops[:events.pulse_length] + c).ravel(), 0)
+        self.events.pulse_words[self.events.pulse_length-n*events.pulse_length:self.events.pulse_length] = np.tile(events.pulse_words[:events.pulse_length], n)
+        self.dds_data[self.nova_index:self.nova_index+n*rows] = np.tile(block.dds_data, (n, 1))
+        self.nova_index += n*rows
+        self.tick += n*block.span # update runtime
+        self.do_state = block.do_state
+
+        return
 
-            dds_temp = np.zeros((1, 4)) # temp data table for dds
-            for _ in range(4): # Novatech table
-                if self.dds_ch[_] in dds_channels:
-                    dds_temp[0, _] = dds_channels[self.dds_ch[_]]
+    def dds_ramp(self, channel, freqs, duration):
+        # one Novatech row per value of channel (frequency, or amplitude in V), the rows spread evenly over duration
+        freqs = np.atleast_1d(np.asarray(freqs, dtype=float))
+        step, n = freqs.size, self.ticks(duration)
+        c = self.tick + (2*np.arange(step, dtype=np.int64)*n + step)//(2*step) # trigger of each row
+
+        assert channel in self.dds_col, print('unknown channel!', channel)
+        assert step < 2 or np.diff(c).min() >= self.nova_set, print('too short!', 'rows %d ticks apart, the Novatech trigger needs %d'%(np.diff(c).min(), self.nova_set))
+
+        rows = np.repeat(self.dds_data[self.nova_index-1][None, :], step, axis=0)
+        rows[:, self.dds_col[channel]] = freqs
+        self._dds(c, rows)
+        self.tick += n # update runtime
+
+        return
+
+    def _dds(self, ticks, rows):
+        # append Novatech rows triggered at ticks, table size and trigger windows checked before anything is written
+        assert self.nova_index + len(rows) <= len(self.dds_data), print('Novatech table full!', '%d + %d rows'%(self.nova_index, len(rows)))
+        self._amplitudes(rows)
+        self._occupy(self.windows, ticks-self.nova_set, ticks, self._owner)
+        self.dds_data[self.nova_index:self.nova_index+len(rows)] = rows
+        self.nova_index += len(rows)
+        self.events.pulse(ticks-self.nova_set, ticks, self.nova_trig) # all Novatech triggers in one go
+        return
+
+    def _amplitudes(self, rows):
+        # amplitude columns in V between 0 and the full scale, the upload would fail only at run time
+        amps = rows[:, 2:4]
+        assert np.all((amps >= 0) & (amps <= self.nova_amp)), print('amplitude out of range!', 'within 0 .. %g V'%self.nova_amp, amps.min(), amps.max())
+        return
+
+    def _wave(self, t, ao_channels, do_channels, tol, resolution):
+        # each channel updated only where its output changes, arrays spread over t as in ramp()
+        n = self.ticks(t)
+        with self.timeline(t) as tl:
+            for i, j in ao_channels.items():
+                if hasattr(j, 'sample'):
+                    ticks, values = j.sample(self.clock, n, tol, resolution)
                 else:
-                    dds_temp[0, _] = self.dds_data[self.nova_index-1, _]
+                    ticks, values = (2*np.arange(len(j), dtype=np.int64)*n + len(j))//(2*len(j)), j
+                tl.set(i, ticks/self.clock, values)
+            for i, j in do_channels.items():
+                tl.set(i, 0, j)
+        return
+
+    def splice(self, block):
+        # place a cached block at the current runtime, False if it collides there and has to be re-encoded
+        c = self.tick # current step
+        n = len(block.dds_data)
+        events = block.events
+        starts, stops = block.runs[0]+c, block.runs[1]+c
+        pulse_starts, pulse_stops = events.starts[:events.pulse_length]+c, events.stops[:events.pulse_length]+c
+
+        if not self._fits(starts, stops, pulse_starts, pulse_stops, events.ticks[:events.length], events.words[:events.length], c):
+            return False
+        self.slots.add(starts, stops, self._owner)
+        self.windows.add(pulse_starts, pulse_stops, self._owner)
+
+        self.events.extend(block.events, c)
+        self.dds_data[self.nova_index:self.nova_index+n, :] = block.dds_data
+        self.nova_index += n
+        self.tick += block.span # update runtime
+        self.do_state = block.do_state
+
+        return True
+
+    def _scratch(self, tick, dds_row, do_state):
+        # empty copy positioned at tick, for re-encoding a single block
+        scratch = copy.copy(self)
+        scratch.events = eventlist()
+        scratch.dds_data = np.zeros_like(self.dds_data)
+        scratch.dds_data[0] = dds_row
+        scratch.nova_index = 1
+        scratch.tick = tick
+        scratch.do_state = do_state
+        scratch.slots, scratch.windows = intervalindex(), intervalindex() # checked against the rest by template._reindex
+        scratch.template = None
+        return scratch
 
-            self.dds_data[self.nova_index:self.nova_index+1, :] = dds_temp
-            self.nova_index +=1
+    def _schedule(self, targets, updates):
+        # place the words of updates (strob/data pairs + trigger, triggered at targets) that do not fit in front of their trigger
+        # an update that cannot keep its slots is moved to the nearest free ticks within the max skew of its channels,
+        # or else split into pairs with their own trigger, each placed within its own channel's skew;
+        # a channel is never written before its previous value is output
+        latch = self._latches()
+        for c, words in zip(targets, updates):
+            c = int(c)
+            pairs = [(words[i], words[i+1]) for i in range(0, len(words)-1, 2)]
+            address = [int(i[1]) >> 16 & 255 for i in pairs]
+            a = c-len(words)+1
 
-            for _ in range(c-self.nova_set, c): # update Novatech trigger
-                self.daq_data[_] += self.nova_trig
+            hit = self.slots.find(a, c+1)
+            if hit < 0 and all(latch[i] < a for i in address): # fixed slots still usable
+                self.slots.add(a, c+1, self._owner)
+                self.events.append(np.arange(a, c+1), np.array(words, dtype=np.uint32))
+                latch[address] = c
+                continue
 
+            if pairs: # move the update as a whole, sharing one trigger
+                skew = int(self.skew[address].min())
+                p = self.slots.nearest(a, c+1, lo=max(a-skew, int(latch[address].max())+1), hi=a+skew)
+                if p is not None:
+                    self.slots.add(p, p+c+1-a, self._owner)
+                    self.events.append(np.arange(p, p+c+1-a), np.array(words, dtype=np.uint32))
+                    latch[address] = p+c-a
+                    continue
+
+            for k in sorted(range(len(pairs)), key=lambda k: self.skew[address[k]]): # strictest channel gets the closest slot
+                i = address[k]
+                p = self.slots.nearest(c-2, c+1, lo=max(c-2-self.skew[i], latch[i]+1), hi=c-2+self.skew[i])
+                hit = self.slots.find(a, c+1) if p is None else hit
+                assert p is not None, print('update collision!', self._conflict(self.slots, hit, a, c+1, self._owner, words) if hit >= 0 else '',
+                    'no free slot for %s within %d ticks of %d'%(self._channels(pairs[k]), self.skew[i], c)) # data update collision
+                self.slots.add(p, p+3, self._owner)
+                self.events.append(np.arange(p, p+3), np.array(pairs[k] + (self.trig_int,), dtype=np.uint32))
+                latch[i] = p+2
+            # a trigger without pairs outputs nothing and is dropped
+
+        return
+
+    def _fits(self, starts, stops, pulse_starts, pulse_stops, ticks, words, offset=0, n=None):
+        # True if the tick runs [starts, stops) and Novatech windows are free, and no channel of words (at ticks+offset)
+        # is written before its previous value is output, with latches from the first n events
+        if len(pulse_starts) and pulse_starts[0] < self.windows.end: # rows are played in trigger order
+            return False
+        if len(starts) == 0 or starts[0] >= self.slots.end: # after everything placed so far
+            return True
+        if (self.slots.find_many(starts, stops) >= 0).any():
+            return False
+        strob = words >= self.strob_int
+        return bool((ticks[strob]+offset > self._latches(n)[words[strob] >> 16 & 255]).all())
+
+    def _latches(self, n=None):
+        # tick at which the last write of each word address (in the first n events) is output, -1 if never written
+        n = self.events.length if n is None else n
+        ticks, words = self.events.ticks[:n], self.events.words[:n]
+        strob = words >= self.strob_int
+        last = np.full(256, -1, dtype=np.int64)
+        np.maximum.at(last, (words[strob] >> 16 & 255).astype(np.intp), ticks[strob])
+
+        trig = np.sort(ticks[words == self.trig_int])
+        i = np.searchsorted(trig, last, side='right') # first trigger after the write
+        latch = last.copy()
+        latch[(last >= 0) & (i < trig.size)] = trig[i[(last >= 0) & (i < trig.size)]]
+        return latch
+
+    def _occupy(self, index, starts, stops, owner, exclude=None):
+        # claim tick intervals in index, reporting conflicts with procedure and channel names
+        if index is self.slots:
+            hit = index.find_many(starts, stops)
+            k = np.flatnonzero(hit >= 0)
+            assert k.size == 0, print('update collision!', self._conflict(index, hit[k[0]], starts[k[0]], stops[k[0]], owner, exclude=exclude)) # data update collision
+        elif len(starts):
+            k = np.flatnonzero(starts < np.r_[index.end, stops[:-1]]) # rows are played in trigger order
+            assert k.size == 0, print('nova trig collision!', self._conflict(index, len(index)-1, starts[k[0]], stops[k[0]], owner) if k[0] == 0 or len(index) == 0 else
+                '%s windows [%d, %d) and [%d, %d)'%(owner, starts[k[0]-1], stops[k[0]-1], starts[k[0]], stops[k[0]])) # Novatech trigger collision
+        index.add(starts, stops, owner)
         return
 
+    def _conflict(self, index, hit, start, stop, owner, words=None, exclude=None):
+        # describe a collision between [start, stop) of owner and interval hit of index
+        s, e = int(index.starts[hit]), int(index.stops[hit])
+        if index is self.windows:
+            ours = theirs = ['nova_trig']
+        else:
+            ticks, stored = self.events.ticks[:self.events.length], self.events.words[:self.events.length]
+            mask = (ticks >= s) & (ticks < e)
+            if exclude is not None: # words of owner already in the event list
+                mask[exclude[0]:exclude[1]] = False
+                words = stored[exclude[0]:exclude[1]][(ticks[exclude[0]:exclude[1]] >= start) & (ticks[exclude[0]:exclude[1]] < stop)]
+            ours, theirs = self._channels(words), self._channels(stored[mask])
+        return '%s %s at ticks [%d, %d) overlaps %s %s at ticks [%d, %d)'%(owner, ours, start, stop, index.owner_of(hit), theirs, s, e)
+
+    def _channels(self, words):
+        # channel names addressed by words
+        if words is None:
+            return []
+        return sorted({self.address.get(int(i) >> 16 & 255, hex(int(i))) for i in words})
+
+    def _state(self):
+        # state an encoded block depends on besides its arguments
+        return (tuple(self.dds_data[self.nova_index-1]), self.do_state)
+
     def ao_update(self, channel=0, voltage=0):
         # data format: 16 bits voltage + 3 bits channel address + 4 bits board address + strob bit
-        data_int = np.uint32((voltage+10.0)*65535/20) + self.ao_brd_list[channel//8] + np.uint32(65536*(channel%8))
-        return np.array([data_int + self.strob_int, data_int], dtype=np.uint32)
+        # channel and voltage may be arrays; returns [..., (strob word, data word)]
+        data_int = np.uint32((np.asarray(voltage)+10.0)*65535/20) + self.ao_base[channel]
+        words = np.empty(np.shape(data_int)+(2,), dtype=np.uint32)
+        words[..., 0] = data_int + self.strob_int
+        words[..., 1] = data_int
+        return words
 
-    def do_update(self, channels={0:0}):
-        brd_2_int = np.uint32(65536) # right board
-        brd_1_int = np.uint32(131072) # middle board
-        brd_0_int = np.uint32(196608) # left board
+    def do_update(self, channel=0, value=0, state=None):
+        # channel and value may be arrays (or a {channel: value} dict); returns strob/data word pairs of the left, middle and right board,
+        # the channels set or cleared on top of the board states (all low if None)
+        if isinstance(channel, dict):
+            channel, value = list(channel.keys()), list(channel.values())
+        channel = np.atleast_1d(np.asarray(channel, dtype=np.intp))
+        value = np.broadcast_to(np.atleast_1d(value).astype(bool), channel.shape)
+        keep = channel < 48 # three boards
+        bits = np.asarray(state if state is not None else (0, 0, 0), dtype=np.uint32).repeat(16) & self.do_mask != 0
+        bits[channel[keep]] = value[keep] # last value wins, as in a dict
+        brd_int = (bits*self.do_mask).reshape(3, 16).sum(axis=1, dtype=np.uint32) + self.do_brd_list
+        words = np.empty(6, dtype=np.uint32)
+        words[0::2] = brd_int + self.strob_int
+        words[1::2] = brd_int
+        return words
 
-        for i, j in channels.items():
-            brd_num = i//16
+    def do_merge(self, do_channels):
+        # merge named channels into the digital state; strob/data words of the boards that changed
+        if len(do_channels) == 0:
+            return []
 
-            if brd_num == 0:
-                brd_0_int += np.uint32( 2**(i%16) * bool(j) )
+        key = (tuple(do_channels.items()), self.do_state)
+        try:
+            hit = self._do_words.get(key)
+        except TypeError: # unhashable values
+            key, hit = None, None
 
-            elif brd_num == 1:
-                brd_1_int += np.uint32( 2**(i%16) * bool(j) )
+        if hit is None:
+            channel = np.fromiter((self.do_ch[i] for i in do_channels), dtype=np.intp, count=len(do_channels)) # unknown names raise KeyError
+            words = self.do_update(channel, list(do_channels.values()), self.do_state)
+            brd_int = words[1::2] - self.do_brd_list
+            changed = np.ones(3, dtype=bool) if self.do_state is None else brd_int != self.do_state # first update writes every board
+            hit = words.reshape(3, 2)[changed].ravel().tolist(), tuple(brd_int.tolist())
+            if key is not None:
+                if len(self._do_words) >= 4096: # loops repeat a few digital states, keep it small
+                    self._do_words.clear()
+                self._do_words[key] = hit
 
-            elif brd_num == 2:
-                brd_2_int += np.uint32( 2**(i%16) * bool(j) )
+        words, self.do_state = hit
+        return list(words)
 
-            else:
-                pass
+    def compile(self, samples=None):
+        # dense NI buffer sized to the real runtime
+        if samples is None:
+            samples = self.tick if self.simulation else int(np.ceil(self.runtime)*self.clock)
+            samples = max(samples, self.slots.end) # writes the scheduler moved past the end
+        return self.events.dense(samples)
 
-        return np.array([brd_0_int + self.strob_int, brd_0_int, brd_1_int + self.strob_int, brd_1_int, brd_2_int + self.strob_int, brd_2_int], dtype=np.uint32)
+    def run(self, stream=False):
+        if stream and not self.simulation: # long sequences: never build the whole dense buffer
+            with HardwareSession(self.clock, self.nova_serial) as session:
+                session.stream(self, self.dds_data[0:self.nova_index, :])
+        else:
+            self.execute(self.compile(), self.dds_data[0:self.nova_index, :])
+        return
 
-    def run(self):
+    def execute(self, daq_data, dds_data):
+        # play compiled buffers, see scan for overlapping this with compiling the next shot
         if self.simulation:
-            #for _ in self.daq_data[0:int(self.runtime*self.clock)]:
+            #for _ in daq_data:
             #    print('{0:032b}'.format(_))
-            print(self.daq_data[0:int(self.runtime*self.clock)].shape)
-            print(self.dds_data[0:self.nova_index, :])
-            del self.daq_data, self.dds_data
+            print(daq_data.shape, self.events.length)
+            print(dds_data)
         else:
-            if self.nova_serial is not '':
-                dds = driver.Novatech409B(self.nova_serial)
-                try:
-                    dds.setup()
-                    dds._ser_send('m 0', get_response=False)
-                    for i in range(self.nova_index):
-                        dds._ser_send('t0 %04x %08x,%04x,%04x,ff'%(i, int(self.dds_data[i, 0]*1e7), 0, 1023), get_response=False)
-                        dds._ser_send('t1 %04x %08x,%04x,%04x,ff'%(i, int(self.dds_data[i, 1]*1e7), 0, 1023), get_response=False)
-                    #dds._ser_send('t0 %04x %08x,%04x,%04x,00'%(i, int(self.dds_data[-1, 0]*1e7), 0, 1023), get_response=False)
-                    #dds._ser_send('t1 %04x %08x,%04x,%04x,00'%(i, int(self.dds_data[-1, 1]*1e7), 0, 1023), get_response=False)
-                    dds._ser_send('m t', get_response=False)
-                except:
-                    print('Novatech error!')
-                finally:
-                    dds.close()
-                    del self.dds_data
-
-            with nidaqmx.Task() as task: # create NI-DAQmx task
-                task.do_channels.add_do_chan('Dev1/port0/line0:7,Dev1/port1/line0:7,Dev1/port2/line0:7,Dev1/port3/line0:7', line_grouping=LineGrouping.CHAN_FOR_ALL_LINES) # group all lines
-                task.timing.cfg_samp_clk_timing(self.clock, sample_mode=AcquisitionType.FINITE, samps_per_chan=int(np.ceil(self.runtime)*self.clock)) # set NI-DAQmx clock and samples
-
-                try:
-                    print(task.write(self.daq_data[0:int(np.ceil(self.runtime)*self.clock)], auto_start=False)) # write data
-                    task.start()
-                    task.wait_until_done(timeout=(np.ceil(self.runtime)+0.1))
-                    task.stop()
-                except nidaqmx.DaqError as e:
-                    print(e)
-                finally:
-                    del self.daq_data
+            with HardwareSession(self.clock, self.nova_serial) as session: # one-off session, keep one open across shots in scans
+                session.execute(self, daq_data, dds_data)
 
         return
 
@@ -0,0 +1,57 @@
+# asyncio front end for the Novatech 409B driver
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from .driver import Novatech409B
+
+
+class AsyncNovatech409B:
+    """Coroutine versions of the Novatech409B methods.
+
+    Serial I/O runs in one dedicated worker thread, which keeps commands to
+    the device in order while the event loop (or other threads) prepare
+    the rest of the shot, e.g. the NI-DAQmx buffer.
+    """
+
+    def __init__(self, serial_dev, timeout=1.):
+        self.driver = Novatech409B(serial_dev, timeout)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    async def _call(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(fn, *args, **kwargs))
+
+    async def close(self):
+        """Close the serial port and stop the worker thread."""
+        await self._call(self.driver.close)
+        self._executor.shutdown(wait=False)
+
+    async def setup(self):
+        """Initial setup of 409B."""
+        await self._call(self.driver.setup)
+
+    async def reset(self):
+        """Hardware reset of 409B."""
+        await self._call(self.driver.reset)
+
+    async def set_freq(self, ch_no, freq):
+        """Set frequency of one channel."""
+        await self._call(self.driver.set_freq, ch_no, freq)
+
+    async def set_phase(self, ch_no, phase):
+        """Set phase of one channel."""
+        await self._call(self.driver.set_phase, ch_no, phase)
+
+    async def set_gain(self, ch_no, volts):
+        """Set amplitude of one channel."""
+        await self._call(self.driver.set_gain, ch_no, volts)
+
+    async def upload_table(self, freqs, **kwargs):
+        """Upload a frequency table, see Novatech409B.upload_table."""
+        return await self._call(self.driver.upload_table, freqs, **kwargs)
+
+    async def get_status(self):
+        return await self._call(self.driver.get_status)
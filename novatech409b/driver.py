@@ -6,6 +6,7 @@ import math
 import logging
 import time
 
+import numpy as np
 import serial
 
 
@@ -38,7 +39,10 @@ class Novatech409B:
         "?f": "Bad Byte"
     }
 
-    def __init__(self, serial_dev):
+    def __init__(self, serial_dev, timeout=1.):
+        self._table = None # shadow of the table last written to the device
+        self._rx = bytearray() # received bytes not yet consumed as lines
+        self.timeout = timeout # seconds to wait for a reply
         if serial_dev is None:
             self.simulation = True
         else:
@@ -49,20 +53,45 @@ class Novatech409B:
                 bytesize=8,
                 parity="N",
                 stopbits=1,
-                xonxoff=0)
+                xonxoff=0,
+                timeout=min(timeout, 0.1))
 
     def close(self):
         """Close the serial port."""
         if not self.simulation:
             self.port.close()
 
-    def _ser_readline(self):
-        c = self.port.read(1)
-        r = c
-        while c != b"\n":
-            c = self.port.read(1)
-            r += c
-        return r
+    def _ser_clear(self):
+        """Discard pending input."""
+        self.port.reset_input_buffer()
+        self._rx.clear()
+
+    def _ser_poll(self):
+        """Move whatever is waiting on the port into the receive buffer,
+        blocking at most the port timeout for the first byte."""
+        self._rx += self.port.read(max(1, self.port.in_waiting))
+
+    def _ser_readline(self, deadline=None):
+        """Return the next line, reading the port in bulk."""
+        if deadline is None:
+            deadline = time.monotonic() + self.timeout
+        while True:
+            i = self._rx.find(b"\n")
+            if i >= 0:
+                r = bytes(self._rx[:i+1])
+                del self._rx[:i+1]
+                return r
+            if time.monotonic() >= deadline:
+                raise UnexpectedResponse("No reply from device within timeout")
+            self._ser_poll()
+
+    def _check_reply(self, cmd, result):
+        logger.debug("got response from device: %s", result)
+        if result != "OK":
+            errstr = self.error_codes.get(result, "Unrecognized reply")
+            s = "Erroneous reply from device to \"{cmd}\": {ec}, {ecs}".format(
+                cmd=cmd, ec=result, ecs=errstr)
+            raise ValueError(s)
 
     def _ser_send(self, cmd, get_response=True):
         """Send a string to the serial port."""
@@ -76,21 +105,137 @@ class Novatech409B:
             logger.info("simulation _ser_send(\"%s\")", cmd)
         else:
             logger.debug("_ser_send(\"%s\")", cmd)
-            self.port.reset_input_buffer()
+            self._ser_clear()
             self.port.write((cmd + "\r\n").encode())
             if get_response:
-                result = (self._ser_readline()).rstrip().decode()
-                logger.debug("got response from device: %s", result)
-                if result != "OK":
-                    errstr = self.error_codes.get(result, "Unrecognized reply")
-                    s = "Erroneous reply from device: {ec}, {ecs}".format(
-                        ec=result, ecs=errstr)
-                    raise ValueError(s)
+                self._check_reply(cmd, (self._ser_readline()).rstrip().decode())
             else:
                 pass
 
+    def _ser_send_many(self, cmds):
+        """Send several commands in one write, then collect their replies.
+
+        The link stays busy instead of idling for a round trip after
+        every command.
+        """
+        if self.simulation:
+            for cmd in cmds:
+                logger.info("simulation _ser_send(\"%s\")", cmd)
+            return
+        logger.debug("_ser_send_many(%s)", cmds)
+        self._ser_clear()
+        self.port.write("".join(cmd + "\r\n" for cmd in cmds).encode())
+        deadline = time.monotonic() + self.timeout*len(cmds)
+        for cmd in cmds:
+            self._check_reply(cmd, (self._ser_readline(deadline)).rstrip().decode())
+
+    @staticmethod
+    def _hex(values, width):
+        """Fixed-width lower-case hex digits of each value as a uint8 array."""
+        shifts = 4*np.arange(width-1, -1, -1, dtype=np.uint64)
+        digits = (np.asarray(values, dtype=np.uint64)[..., None] >> shifts) & np.uint64(0xf)
+        return np.frombuffer(b"0123456789abcdef", dtype=np.uint8)[digits]
+
+    def _table_lines(self, table):
+        """Format "tN iiii ffffffff,pppp,aaaa,dd" commands for every row and
+        channel of a (rows, channels, 4) table of integer fields into a
+        (rows, channels, 31) uint8 array, without a Python loop over rows."""
+        rows, channels = table.shape[:2]
+        line = np.frombuffer(b"t0 0000 00000000,0000,0000,00\r\n", dtype=np.uint8)
+        lines = np.tile(line, (rows, channels, 1))
+
+        lines[:, :, 1] = ord("0") + np.arange(channels, dtype=np.uint8)
+        lines[:, :, 3:7] = self._hex(np.arange(rows), 4)[:, None, :]
+        lines[:, :, 8:16] = self._hex(table[..., 0], 8)
+        lines[:, :, 17:21] = self._hex(table[..., 1], 4)
+        lines[:, :, 22:26] = self._hex(table[..., 2], 4)
+        lines[:, :, 27:29] = self._hex(table[..., 3], 2)
+        return lines
+
+    def upload_table(self, freqs, phases=0, amps=1023, dwell=0xff,
+                     mode="t", block=4096, timeout=None, full=False):
+        """Upload a table of frequencies in one serial write.
+
+        Sends "m 0", one "tN" command per row and channel, then "m <mode>".
+        Errors are collected after the whole upload instead of after each
+        command. Entries identical to the last successful upload are
+        skipped unless full is set; the shadow is only kept once every
+        command is acknowledged with "OK", so reset(), errors and missing
+        replies force a full upload.
+
+        :param freqs: array (rows, channels) of frequencies in Hz
+        :param phases: phase words, broadcast to freqs
+        :param amps: amplitude DAC values (0 to 1023), broadcast to freqs
+        :param dwell: dwell byte, 0xff to wait for the next trigger
+        :param mode: table mode started after the upload
+        :param block: bytes per port.write() call
+        :param timeout: seconds to wait for the device replies, default self.timeout
+        :param full: upload every entry regardless of the shadow table
+        :return: number of table entries sent
+        """
+        freqs = np.atleast_2d(np.asarray(freqs, dtype=float))
+        words = np.round(freqs*10) # frequency word in 0.1 Hz
+        if len(freqs) > 32768:
+            raise ValueError("Table too long {n}".format(n=len(freqs)))
+        if not np.all(np.isfinite(freqs)) or np.any(words < 0) or np.any(words >= 2**32):
+            raise ValueError("Frequency out of range")
+        amps = np.broadcast_to(amps, freqs.shape)
+        if not np.all(np.isfinite(amps)) or np.any(amps < 0) or np.any(amps > 1023):
+            raise ValueError("Amplitude out of range")
+
+        table = np.stack(np.broadcast_arrays(words, phases, amps, dwell), axis=-1).astype(np.int64)
+        rows, channels = freqs.shape
+
+        # entries that differ from what the device already holds
+        changed = np.ones((rows, channels), dtype=bool)
+        shadow = self._table
+        if not full and shadow is not None and shadow.shape[1] == channels:
+            n = min(rows, len(shadow))
+            changed[:n] = np.any(table[:n] != shadow[:n], axis=-1)
+
+        blob = (b"m 0\r\n"
+                + self._table_lines(table)[changed].tobytes()
+                + "m {}\r\n".format(mode).encode())
+        commands = int(changed.sum()) + 2
+
+        if self.simulation:
+            logger.info("simulation upload_table(%d rows, %d entries)", rows, commands-2)
+            return commands-2
+
+        logger.debug("upload_table(%d rows, %d entries, %d bytes)", rows, commands-2, len(blob))
+        self._table = None # device state unknown until verified
+        self._ser_clear()
+        for i in range(0, len(blob), block):
+            self.port.write(blob[i:i+block])
+            self._rx += self.port.read(self.port.in_waiting) # keep the input buffer drained
+        self.port.flush()
+
+        # deferred verification of all replies
+        replies = []
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+        try:
+            while len(replies) < commands:
+                replies.append(self._ser_readline(deadline).rstrip().decode(errors="replace"))
+        except UnexpectedResponse: # missing replies, checked below
+            pass
+        errors = [(i, r) for i, r in enumerate(replies) if r != "OK"]
+        if errors:
+            i, r = errors[0]
+            s = "Erroneous reply from device during table upload: {n} errors, first {ec}, {ecs} (command {i})".format(
+                n=len(errors), ec=r, ecs=self.error_codes.get(r, "Unrecognized reply"), i=i)
+            raise ValueError(s)
+        if len(replies) < commands: # unverified, the next upload is full
+            logger.warning("upload_table: %d of %d replies within timeout", len(replies), commands)
+            return commands-2
+
+        if shadow is not None and shadow.shape[1] == channels and len(shadow) > rows: # rows beyond this table are unchanged
+            table = np.concatenate((table, shadow[rows:]))
+        self._table = table
+        return commands-2
+
     def reset(self):
         """Hardware reset of 409B."""
+        self._table = None # table memory is lost, next upload is full
         self._ser_send("R", get_response=False)
         time.sleep(1)
         self.setup()
@@ -103,8 +248,7 @@ class Novatech409B:
         # * external clock ("") 10 MHz sinusoid -1 to +7 dBm
 
         self._ser_send("E d", get_response=False)
-        self.set_phase_continuous(True)
-        self.set_simultaneous_update(False)
+        self._ser_send_many(["M n", "I a"]) # phase continuous, automatic update
 
     def save_state_to_eeprom(self):
         """Save current state to EEPROM."""
@@ -179,11 +323,12 @@ class Novatech409B:
                     "00989680 2000 01F5 0000 00000000 00000000 000301",
                     "80 BC0000 0000 0102 21"]
         else:
-            self.port.reset_input_buffer()
+            self._ser_clear()
             result = []
             self.port.write(("QUE" + "\r\n").encode())
+            deadline = time.monotonic() + self.timeout
             for i in range(6):
-                m = (self._ser_readline()).rstrip().decode()
+                m = (self._ser_readline(deadline)).rstrip().decode()
                 result.append(m)
             logger.debug("got device status: %s", result)
             return result
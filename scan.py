@@ -0,0 +1,69 @@
+import itertools
+import timeit
+from concurrent.futures import ThreadPoolExecutor
+
+def _compile(factory, params):
+    # build and compile one shot, runs in the worker
+    begin = timeit.default_timer()
+    exp = factory(**params)
+    daq_data = exp.compile()
+    dds_data = exp.dds_data[0:exp.nova_index, :].copy()
+    return exp, daq_data, dds_data, timeit.default_timer() - begin
+
+class scan:
+
+    # pipelined parameter scan: shot N+1 is compiled in a worker while shot N runs
+
+    def __init__(self, factory, grid, backend=None, executor=None):
+        self.factory = factory # factory(**params) returns a procedure with its sequence built, not run
+        if isinstance(grid, dict): # {name: values} -> full grid
+            self.points = [dict(zip(grid, i)) for i in itertools.product(*grid.values())]
+        else: # list of {name: value}
+            self.points = list(grid)
+        self.backend = backend # None for exp.execute, e.g. hardware.simulator() for tests
+        self.executor = executor # None for a single worker thread; a ProcessPoolExecutor needs a picklable factory
+        self.results = []
+
+    def run(self, callback=None):
+        executor = self.executor if self.executor is not None else ThreadPoolExecutor(max_workers=1)
+        self.results = []
+        stop = None
+
+        try:
+            pending = executor.submit(_compile, self.factory, self.points[0]) if self.points else None
+
+            for i, params in enumerate(self.points):
+                exp, daq_data, dds_data, compile_time = pending.result() # hand over finished buffers
+
+                if i+1 < len(self.points): # compile next shot while this one runs
+                    pending = executor.submit(_compile, self.factory, self.points[i+1])
+
+                start = timeit.default_timer()
+                if self.backend is None:
+                    exp.execute(daq_data, dds_data)
+                else:
+                    self.backend.execute(exp, daq_data, dds_data)
+                del daq_data, dds_data
+
+                self.results.append({
+                    'params': params,
+                    'compile': compile_time, # sec
+                    'run': timeit.default_timer() - start, # sec
+                    'dead': 0. if stop is None else start - stop # sec between shots
+                })
+                stop = timeit.default_timer()
+
+                if callback is not None:
+                    callback(params, exp)
+
+        finally:
+            if self.executor is None:
+                executor.shutdown(wait=False, cancel_futures=True)
+
+        return self.results
+
+    @property
+    def dead_time(self):
+        # mean dead time between shots (sec)
+        dead = [i['dead'] for i in self.results[1:]]
+        return sum(dead)/len(dead) if dead else 0.
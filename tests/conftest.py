@@ -0,0 +1,13 @@
+import os
+import sys
+
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+
+@pytest.fixture(autouse=True)
+def repo_root(monkeypatch):
+    # settings reads config.ini from the working directory
+    monkeypatch.chdir(root)
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+import experiment
+import fakedaqmx
+import hardware
+
+
+@pytest.fixture
+def exp():
+    exp = experiment.procedure(simulation=True)
+    exp.mot(t=0.05)
+    exp.cmot()
+    exp.tof()
+    return exp
+
+
+def test_stream_chunks_match_compile(exp):
+    samples = max(int(np.ceil(exp.runtime)*exp.clock), exp.slots.end)
+    chunk = 3*10**6 + 7 # does not divide the sample count
+
+    with hardware.HardwareSession(exp.clock, daqmx=fakedaqmx) as session:
+        session.stream(exp, exp.dds_data[:exp.nova_index], chunk=chunk, depth=2)
+        task = session.task
+
+    assert [len(i) for i in task.chunks[:-1]] == [chunk]*(len(task.chunks)-1)
+    assert task.calls['callback'] == samples//chunk
+    assert np.array_equal(np.concatenate(task.chunks), exp.compile(samples))
+
+
+def test_stream_underflow(exp, capsys):
+    with hardware.HardwareSession(exp.clock, daqmx=fakedaqmx) as session:
+        write = session.writer.write_many_sample_port_uint32
+
+        def prefill_only(data, timeout=10.): # the callbacks never refill, the buffer runs dry
+            if session.task.calls['write'] < 2:
+                write(data, timeout=timeout)
+
+        session.writer.write_many_sample_port_uint32 = prefill_only
+        session.stream(exp, exp.dds_data[:exp.nova_index], chunk=10**6, depth=2)
+        assert session.task.calls['stop'] == 1 # stopped after the error
+        assert session.task.callback is None # callback unregistered
+
+    assert 'underflow' in capsys.readouterr().out
+
+
+def test_fake_underflow_error_code():
+    task = fakedaqmx.Task()
+    task.timing.cfg_samp_clk_timing(20e6, samps_per_chan=1000)
+    task.out_stream.regen_mode = fakedaqmx.constants.RegenerationMode.DONT_ALLOW_REGENERATION
+    task.out_stream.output_buf_size = 400
+    task.write(np.zeros(400, dtype=np.uint32), auto_start=False)
+    task.register_every_n_samples_transferred_from_buffer_event(200, lambda *args: 0)
+    task.start()
+
+    with pytest.raises(fakedaqmx.DaqError) as error:
+        task.wait_until_done()
+    assert error.value.error_code == -200290
+    assert task.transferred == 400
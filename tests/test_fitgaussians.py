@@ -0,0 +1,17 @@
+import numpy as np
+import pytest
+
+from functions import fitgaussians
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_blank_frame_fails_alone(workers):
+    x, y = np.mgrid[:64, :64]
+    cloud = np.exp(-((x-30)**2 + (y-34)**2)/50).astype(np.float32)
+    stack = np.stack([cloud, cloud, np.zeros_like(cloud), cloud, cloud]) # a no-atom shot
+
+    fits = fitgaussians(stack, workers=workers, warm=True)
+
+    assert fits['success'].tolist() == [True, True, False, True, True]
+    assert np.isnan(fits[2]['pos_x']) and fits[2]['nfev'] == 0
+    assert np.allclose(fits['pos_x'][fits['success']], 30, atol=1e-3)
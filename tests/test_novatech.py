@@ -0,0 +1,64 @@
+import logging
+
+import numpy as np
+import pytest
+
+import fakenovatech
+from novatech409b.driver import Novatech409B
+
+
+@pytest.fixture
+def dds():
+    dds = Novatech409B('fakenovatech://', timeout=0.2)
+    yield dds
+    dds.close()
+
+
+def test_upload_table_blob(dds):
+    n = dds.upload_table([[1e8, 2e8], [1.5e8, 2.5e8]], amps=[1023, 512])
+
+    assert n == 4
+    assert bytes(dds.port.received) == (b"m 0\r\n"
+        b"t0 0000 3b9aca00,0000,03ff,ff\r\n"
+        b"t1 0000 77359400,0000,0200,ff\r\n"
+        b"t0 0001 59682f00,0000,03ff,ff\r\n"
+        b"t1 0001 9502f900,0000,0200,ff\r\n"
+        b"m t\r\n")
+    assert dds.port.table[1, 1] == (2500000000, 0, 512, 0xff)
+    assert dds.port.mode == "t"
+
+
+def test_upload_table_skips_unchanged(dds):
+    dds.upload_table([[1e8, 2e8], [1.5e8, 2.5e8]])
+    dds.port.received.clear()
+
+    assert dds.upload_table([[1e8, 2e8], [1.5e8, 2.6e8]]) == 1
+    assert bytes(dds.port.received) == b"m 0\r\nt1 0001 9af8da00,0000,03ff,ff\r\nm t\r\n"
+
+
+def test_upload_table_errors_deferred(dds):
+    dds.port.replies = {2: "?1", 4: "?7"} # second and fourth table entry
+
+    with pytest.raises(ValueError, match=r"2 errors, first \?1, Bad Frequency \(command 2\)"):
+        dds.upload_table(np.full((3, 2), 1e8))
+    assert dds.port.received.count(b"\r\n") == 8 # every command was sent before the replies were checked
+
+    dds.port.replies = {}
+    assert dds.upload_table(np.full((3, 2), 1e8)) == 6 # no shadow after an error
+
+
+def test_upload_table_missing_replies(dds, caplog):
+    dds.port.mute = True
+    with caplog.at_level(logging.WARNING):
+        assert dds.upload_table([[1e8, 2e8]], timeout=0.3) == 2
+    assert "0 of 4 replies" in caplog.text
+
+    dds.port.mute = False
+    assert dds.upload_table([[1e8, 2e8]]) == 2 # unverified, sent again
+
+
+@pytest.mark.parametrize('freqs, amps', [([[np.nan, 1e8]], 1023), ([[1e8, 1e8]], np.nan), ([[-1., 1e8]], 1023), ([[1e8, 1e8]], 1024)])
+def test_upload_table_range(dds, freqs, amps):
+    with pytest.raises(ValueError, match="out of range"):
+        dds.upload_table(freqs, amps=amps)
+    assert not dds.port.received